@@ -0,0 +1,130 @@
+import struct
+import tempfile
+import threading
+
+import numpy as np
+import soundfile
+
+STREAM_SIZE = 0xFFFFFFFF
+TRANSCODE_BLOCK_SIZE = 65536
+FORMATS = {
+    'wav': {'extension': 'wav', 'format': 'WAV', 'subtype': 'PCM_16', 'mime': 'audio/wav'},
+    'float': {'extension': 'wav', 'format': 'WAV', 'subtype': 'FLOAT', 'mime': 'audio/wav'},
+    'flac': {'extension': 'flac', 'format': 'FLAC', 'subtype': 'PCM_16', 'mime': 'audio/flac'}
+}
+MIME_ALIASES = {
+    'audio/x-wav': 'audio/wav',
+    'audio/wave': 'audio/wav',
+    'audio/x-flac': 'audio/flac'
+}
+
+
+def wav_header(sample_rate: int, channels: int = 1, bits: int = 16, data_size: int = STREAM_SIZE) -> bytes:
+    """
+    Build a PCM WAV header. The default data size marks a stream of unknown length,
+    which most players accept and play until the connection closes.
+    """
+    block_align = channels * bits // 8
+    riff_size = STREAM_SIZE if data_size == STREAM_SIZE else 36 + data_size
+    return b''.join([
+        b'RIFF', struct.pack('<I', riff_size), b'WAVE',
+        b'fmt ', struct.pack('<IHHIIHH', 16, 1, channels, sample_rate, sample_rate * block_align, block_align, bits),
+        b'data', struct.pack('<I', data_size)
+    ])
+
+
+def float_to_pcm16(waveform: np.ndarray) -> bytes:
+    return (np.clip(waveform, -1., 1.) * 32767).astype('<i2').tobytes()
+
+
+def negotiate_format(stored: str, requested: str = None, accept: str = None):
+    """
+    Choose the output format from an explicit format name or an Accept header,
+    preferring the stored format so that it can be served without transcoding.
+    Returns None if none of the acceptable formats is supported.
+    """
+    if requested:
+        return requested if requested in FORMATS else None
+    if not accept:
+        return stored
+    ranges = []
+    for i, part in enumerate(accept.split(',')):
+        fields = part.split(';')
+        mime = fields[0].strip().lower()
+        quality = 1.
+        for param in fields[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    pass
+        ranges.append((-quality, i, MIME_ALIASES.get(mime, mime)))
+    for negative_quality, _, mime in sorted(ranges):
+        if negative_quality >= 0:
+            break
+        if mime in ['*/*', 'audio/*']:
+            return stored
+        candidates = [name for name, fmt in FORMATS.items() if fmt['mime'] == mime]
+        if stored in candidates:
+            return stored
+        if candidates:
+            return candidates[0]
+    return None
+
+
+def transcode(source, target: str, path: str = None):
+    """
+    Transcode an audio file (path or file object) block by block into the file at `path` or else an anonymous
+    temporary file, which is returned positioned at its beginning.
+    """
+    fmt = FORMATS[target]
+    out = tempfile.TemporaryFile() if path is None else open(path, 'w+b')
+    with soundfile.SoundFile(source) as src, soundfile.SoundFile(
+            out, 'w', samplerate=src.samplerate, channels=src.channels,
+            format=fmt['format'], subtype=fmt['subtype']) as dst:
+        for block in src.blocks(blocksize=TRANSCODE_BLOCK_SIZE, dtype='float32'):
+            dst.write(block)
+    out.seek(0)
+    return out
+
+
+class ChunkStream:
+    """
+    A growing sequence of PCM chunks produced by one synthesis task and consumed by any number of readers.
+    Every reader starts from the first chunk, so readers joining late still receive the whole audio.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.finished = False
+        self.error = None
+        self._cond = threading.Condition()
+
+    def put(self, data: bytes):
+        with self._cond:
+            self.chunks.append(data)
+            self._cond.notify_all()
+
+    def close(self, error: str = None):
+        with self._cond:
+            if self.finished:
+                return
+            self.finished = True
+            self.error = error
+            self._cond.notify_all()
+
+    def read(self):
+        index = 0
+        while True:
+            with self._cond:
+                while index >= len(self.chunks) and not self.finished:
+                    self._cond.wait()
+                pending = self.chunks[index:]
+                index = len(self.chunks)
+                finished = self.finished
+            yield from pending
+            if finished:
+                if self.error is not None:
+                    raise RuntimeError(self.error)
+                return
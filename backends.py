@@ -0,0 +1,254 @@
+"""
+Task state and results shared by several engine nodes.
+
+Every node keeps its own queue, sessions and local caches. Through a backend, nodes also agree on which of
+them synthesizes a token (so that the same song is rendered once behind a load balancer), hand over the tasks
+of nodes that stopped renewing their leases, and publish results so that /query and /download work on any
+node. `Backend` is the interface to implement for a remote store; `SQLiteBackend` keeps everything in a
+directory on a shared volume.
+"""
+import importlib
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+
+import utils
+
+LIVE_STATUSES = ('QUEUED', 'RUNNING')
+
+
+class Backend:
+    """
+    Shared store of task leases and results.
+
+    A task row holds the node owning the token, its status (QUEUED, RUNNING or FAILED), the task as submitted
+    (a JSON-serializable dict, so that another node can take it over) and the expiry time of the lease.
+    Results are whole files stored by cache key. All times are wall-clock times, as they are compared across
+    nodes.
+    """
+
+    def __init__(self, node: str, lease: float):
+        self.node = node
+        self.lease = lease
+
+    def claim(self, token: str, task: dict) -> str:
+        """
+        Take `token` for this node unless another node holds a live lease on it. Returns the owning node.
+        """
+        raise NotImplementedError()
+
+    def renew(self, tokens: list):
+        """
+        Extend the leases of the given tokens owned by this node.
+        """
+        raise NotImplementedError()
+
+    def update(self, token: str, status: str, message: str = None):
+        """
+        Set the status of a task owned by this node. A FINISHED task is removed, as its result stands for it.
+        """
+        raise NotImplementedError()
+
+    def release(self, token: str):
+        """
+        Drop a task owned by this node, e.g. after it has been cancelled.
+        """
+        raise NotImplementedError()
+
+    def status(self, token: str):
+        """
+        Return {'status', 'node', 'message', 'expired'} of a task, or None if there is no row for it.
+        """
+        raise NotImplementedError()
+
+    def expired(self) -> list:
+        """
+        Return (token, task) pairs of live tasks whose lease has run out.
+        """
+        raise NotImplementedError()
+
+    def has_result(self, key: str) -> bool:
+        raise NotImplementedError()
+
+    def store(self, key: str, path: str):
+        """
+        Publish the file at `path` as the result of `key`.
+        """
+        raise NotImplementedError()
+
+    def fetch(self, key: str, path: str) -> bool:
+        """
+        Copy the result of `key` to `path`. Returns False if there is none.
+        """
+        raise NotImplementedError()
+
+    def discard(self, key: str):
+        raise NotImplementedError()
+
+    def sweep(self, max_age: float):
+        """
+        Remove results and failed tasks older than `max_age` seconds (0 keeps them).
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend(Backend):
+    """
+    Backend in a directory on a volume shared by all nodes: task rows live in an SQLite database and results
+    are files named after their keys.
+
+    The database uses the default rollback journal rather than WAL, which needs shared memory and therefore
+    does not work across hosts. Claims run in an immediate transaction, so two nodes never both win a token.
+    """
+
+    def __init__(self, directory: str, extension: str, node: str, lease: float):
+        super().__init__(node, lease)
+        self.directory = directory
+        self.extension = extension
+        self.results = os.path.join(directory, 'results')
+        os.makedirs(self.results, exist_ok=True)
+        self._conn = sqlite3.connect(
+            os.path.join(directory, 'tasks.db'), timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS tasks ('
+            'token TEXT PRIMARY KEY, node TEXT NOT NULL, status TEXT NOT NULL, task TEXT NOT NULL, '
+            'message TEXT, expires REAL NOT NULL, updated REAL NOT NULL)'
+        )
+        self._mutex = threading.Lock()
+
+    def claim(self, token: str, task: dict) -> str:
+        now = time.time()
+        with self._mutex:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute(
+                    'SELECT node, status, expires FROM tasks WHERE token = ?', (token,)
+                ).fetchone()
+                owner = self.node
+                if row is not None and row[0] != self.node and row[1] in LIVE_STATUSES and row[2] > now:
+                    owner = row[0]
+                else:
+                    self._conn.execute(
+                        'INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, NULL, ?, ?)',
+                        (token, self.node, 'QUEUED', json.dumps(task), now + self.lease, now)
+                    )
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+        if owner == self.node and row is not None and row[0] != self.node and row[1] in LIVE_STATUSES:
+            logging.warning(f'Took over task \'{token}\' from node \'{row[0]}\' whose lease expired')
+        return owner
+
+    def renew(self, tokens: list):
+        if not tokens:
+            return
+        now = time.time()
+        with self._mutex:
+            self._conn.executemany(
+                'UPDATE tasks SET expires = ? WHERE token = ? AND node = ?',
+                [(now + self.lease, token, self.node) for token in tokens]
+            )
+
+    def update(self, token: str, status: str, message: str = None):
+        now = time.time()
+        with self._mutex:
+            if status == 'FINISHED':
+                self._conn.execute('DELETE FROM tasks WHERE token = ? AND node = ?', (token, self.node))
+            else:
+                self._conn.execute(
+                    'UPDATE tasks SET status = ?, message = ?, expires = ?, updated = ? WHERE token = ? AND node = ?',
+                    (status, message, now + self.lease, now, token, self.node)
+                )
+
+    def release(self, token: str):
+        with self._mutex:
+            self._conn.execute('DELETE FROM tasks WHERE token = ? AND node = ?', (token, self.node))
+
+    def status(self, token: str):
+        with self._mutex:
+            row = self._conn.execute(
+                'SELECT status, node, message, expires FROM tasks WHERE token = ?', (token,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            'status': row[0],
+            'node': row[1],
+            'message': row[2],
+            'expired': row[0] in LIVE_STATUSES and row[3] <= time.time()
+        }
+
+    def expired(self) -> list:
+        with self._mutex:
+            rows = self._conn.execute(
+                'SELECT token, task FROM tasks WHERE status IN (?, ?) AND expires <= ?', (*LIVE_STATUSES, time.time())
+            ).fetchall()
+        return [(token, json.loads(task)) for token, task in rows]
+
+    def _path(self, key: str) -> str:
+        # Keys are tokens or draft keys; anything else could point outside the results directory.
+        if re.fullmatch('[0-9a-f]{32}(-draft)?', key) is None:
+            raise ValueError(f'Invalid result key \'{key}\'.')
+        return os.path.join(self.results, f'{key}.{self.extension}')
+
+    def has_result(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def store(self, key: str, path: str):
+        temp_path = f'{self._path(key)}.{utils.random_string(8)}.part'
+        shutil.copyfile(path, temp_path)
+        os.replace(temp_path, self._path(key))
+
+    def fetch(self, key: str, path: str) -> bool:
+        try:
+            shutil.copyfile(self._path(key), path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def discard(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def sweep(self, max_age: float):
+        if max_age <= 0:
+            return
+        deadline = time.time() - max_age
+        with self._mutex:
+            self._conn.execute('DELETE FROM tasks WHERE status = ? AND updated < ?', ('FAILED', deadline))
+        for entry in os.scandir(self.results):
+            try:
+                if entry.stat().st_mtime < deadline:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                # Removed by another node in the meantime
+                continue
+
+    def close(self):
+        with self._mutex:
+            self._conn.close()
+
+
+def create_backend(backend_config: dict, directory: str, extension: str, node: str) -> Backend:
+    """
+    Create the backend selected by `type`: 'sqlite' or the dotted path of a `Backend` subclass, which is
+    constructed with the backend config, the node name and the lease length.
+    """
+    if backend_config['type'] == 'sqlite':
+        return SQLiteBackend(directory, extension, node, backend_config['lease'])
+    module_name, _, class_name = backend_config['type'].rpartition('.')
+    cls = getattr(importlib.import_module(module_name), class_name)
+    assert issubclass(cls, Backend), f'\'{backend_config["type"]}\' is not a backend.'
+    return cls(backend_config, node, backend_config['lease'])
@@ -0,0 +1,95 @@
+import logging
+import math
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """
+    Collects inference items that share the same key and run them as one batch.
+
+    Items are grouped into length buckets (lengths within a factor of `bucket_ratio` from each other)
+    so that one long item does not inflate the padding of the whole batch. A batch is dispatched
+    once it is full or once its oldest item has waited for `window` seconds.
+    `run_batch(key, items)` must return one result per item, in the same order.
+    """
+
+    def __init__(self, run_batch, window: float, max_batch_size: int, bucket_ratio: float, name: str = 'batch'):
+        self.run_batch = run_batch
+        self.window = window
+        self.max_batch_size = max(max_batch_size, 1)
+        self.bucket_ratio = max(bucket_ratio, 1.01)
+        self.name = name
+        self.batches = 0
+        self.items = 0
+        self.real_length = 0
+        self.padded_length = 0
+        self._queues = {}
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._loop, name=f'{name}-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, key, item, length: int) -> Future:
+        future = Future()
+        bucket = (key, int(math.log(max(length, 1), self.bucket_ratio)))
+        with self._cond:
+            self._queues.setdefault(bucket, []).append((item, length, future, time.monotonic()))
+            self._cond.notify()
+        return future
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'batches': self.batches,
+                'items': self.items,
+                'fill_rate': self.items / (self.batches * self.max_batch_size) if self.batches else 0.,
+                'padding_efficiency': self.real_length / self.padded_length if self.padded_length else 1.
+            }
+
+    def _next_batch(self):
+        now = time.monotonic()
+        ready = None
+        deadline = None
+        for bucket, queue in self._queues.items():
+            due = queue[0][3] + self.window
+            if len(queue) >= self.max_batch_size or due <= now:
+                if ready is None or queue[0][3] < self._queues[ready][0][3]:
+                    ready = bucket
+            elif deadline is None or due < deadline:
+                deadline = due
+        if ready is None:
+            return None, (None if deadline is None else deadline - now)
+        queue = self._queues[ready]
+        entries = queue[:self.max_batch_size]
+        del queue[:self.max_batch_size]
+        if not queue:
+            self._queues.pop(ready)
+        return (ready[0], entries), None
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                batch, timeout = self._next_batch()
+                while batch is None:
+                    self._cond.wait(timeout)
+                    batch, timeout = self._next_batch()
+            key, entries = batch
+            entries = [entry for entry in entries if entry[2].set_running_or_notify_cancel()]
+            if not entries:
+                continue
+            try:
+                results = self.run_batch(key, [entry[0] for entry in entries])
+            except Exception as e:
+                for entry in entries:
+                    entry[2].set_exception(e)
+                continue
+            for entry, result in zip(entries, results):
+                entry[2].set_result(result)
+            with self._cond:
+                self.batches += 1
+                self.items += len(entries)
+                self.real_length += sum(entry[1] for entry in entries)
+                self.padded_length += len(entries) * max(entry[1] for entry in entries)
+            logging.debug(f'{self.name.capitalize()} batch of {len(entries)} finished '
+                          f'(fill rate {self.stats()["fill_rate"]:.2f})')
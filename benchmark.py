@@ -0,0 +1,426 @@
+"""
+Benchmarks of the inference engine.
+
+Scenarios:
+    rhythm          run synthesis.predict_rhythm on generated phrases.
+    synthesis       run synthesis.run_synthesis on generated songs.
+    http            run /submit -> /query -> /download against a server started with the same config,
+                    or against a running server given by --url.
+    segmentation    synthesize one long song in a single shot and with segmented synthesis,
+                    each in a fresh process, and compare wall time and peak RSS.
+
+With --synthetic, tiny stand-in ONNX models with the input and output signatures of the real rhythmizer,
+acoustic model and vocoder are generated (requires the `onnx` package), so that the engine itself can be
+measured without downloading any model. Results are printed as JSON.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import yaml
+
+import metrics
+import synthesis
+import utils
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+SERVER_ROOT = os.path.dirname(os.path.abspath(__file__))
+CONFIG_ROOT = os.path.join(SERVER_ROOT, 'configs')
+SYNTHETIC_MODEL = 'synthetic'
+PERCENTILES = [50, 90, 99]
+
+
+def create_synthetic_models(directory: str, num_mel_bins: int, hop_size: int) -> dict:
+    """
+    Write stand-in ONNX models into `directory` and return their paths:
+    the rhythmizer scales note durations, the acoustic model projects f0 onto `num_mel_bins` bins
+    and the vocoder projects every mel frame onto `hop_size` samples.
+    """
+    try:
+        import onnx
+        from onnx import helper, numpy_helper, TensorProto
+    except ImportError:
+        raise ImportError('Synthetic models require the onnx package. Install it with `pip install onnx`.')
+
+    def save(name, nodes, inputs, outputs, initializers):
+        graph = helper.make_graph(nodes, name, inputs, outputs, [
+            numpy_helper.from_array(value, key) for key, value in initializers.items()
+        ])
+        model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)])
+        model.ir_version = 8
+        path = os.path.join(directory, f'{name}.onnx')
+        onnx.save(model, path)
+        return path
+
+    rng = np.random.default_rng(0)
+    return {
+        'rhythmizer': save('rhythmizer', [
+            helper.make_node('Mul', ['midi_dur', 'ratio'], ['ph_dur'])
+        ], [
+            helper.make_tensor_value_info('tokens', TensorProto.INT64, ['B', 'N']),
+            helper.make_tensor_value_info('midi', TensorProto.INT64, ['B', 'N']),
+            helper.make_tensor_value_info('midi_dur', TensorProto.FLOAT, ['B', 'N']),
+            helper.make_tensor_value_info('is_slur', TensorProto.BOOL, ['B', 'N'])
+        ], [
+            helper.make_tensor_value_info('ph_dur', TensorProto.FLOAT, ['B', 'N'])
+        ], {
+            'ratio': np.array(0.3, dtype=np.float32)
+        }),
+        'acoustic': save(SYNTHETIC_MODEL, [
+            helper.make_node('Unsqueeze', ['f0', 'axes'], ['f0_3d']),
+            helper.make_node('MatMul', ['f0_3d', 'weight'], ['mel'])
+        ], [
+            helper.make_tensor_value_info('tokens', TensorProto.INT64, ['B', 'N']),
+            helper.make_tensor_value_info('durations', TensorProto.INT64, ['B', 'N']),
+            helper.make_tensor_value_info('f0', TensorProto.FLOAT, ['B', 'T']),
+            helper.make_tensor_value_info('speedup', TensorProto.INT64, [])
+        ], [
+            helper.make_tensor_value_info('mel', TensorProto.FLOAT, ['B', 'T', num_mel_bins])
+        ], {
+            'axes': np.array([2], dtype=np.int64),
+            'weight': rng.standard_normal((1, num_mel_bins), dtype=np.float32) * 1e-3
+        }),
+        'vocoder': save('vocoder', [
+            helper.make_node('MatMul', ['mel', 'weight'], ['frames']),
+            helper.make_node('Reshape', ['frames', 'shape'], ['waveform'])
+        ], [
+            helper.make_tensor_value_info('mel', TensorProto.FLOAT, ['B', 'T', num_mel_bins]),
+            helper.make_tensor_value_info('f0', TensorProto.FLOAT, ['B', 'T'])
+        ], [
+            helper.make_tensor_value_info('waveform', TensorProto.FLOAT, ['B', 'S'])
+        ], {
+            'weight': rng.standard_normal((num_mel_bins, hop_size), dtype=np.float32) * 1e-2,
+            'shape': np.array([0, -1], dtype=np.int64)
+        })
+    }
+
+
+def make_request(dictionary: dict, seconds: float, seed: int = 0) -> dict:
+    """
+    Generate a synthesis request of about `seconds` seconds: phrases of random words separated by rests,
+    sung along a slowly varying f0 curve.
+    """
+    rng = random.Random(seed)
+    words = [phonemes for phonemes in dictionary.values() if phonemes]
+    phonemes = []
+    length = 0.
+    while length < seconds:
+        rest = {'name': rng.choice(['SP', 'AP']), 'duration': rng.uniform(0.2, 0.8)}
+        phonemes.append(rest)
+        length += rest['duration']
+        for _ in range(rng.randint(4, 12)):
+            for name in rng.choice(words):
+                phonemes.append({'name': name, 'duration': rng.uniform(0.05, 0.3)})
+                length += phonemes[-1]['duration']
+    timestep = 0.005
+    t = np.arange(int(length / timestep) + 2) * timestep
+    f0 = 220. * 2 ** ((3 * np.sin(t / 2 + seed) + np.sin(t * 5)) / 12)
+    return {
+        'phonemes': phonemes,
+        'f0': {
+            'timestep': timestep,
+            'values': f0.tolist()
+        }
+    }
+
+
+def make_notes(dictionary: dict, seconds: float, seed: int = 0) -> list:
+    """
+    Generate a phrase of about `seconds` seconds for the rhythmizer, with occasional slurs.
+    """
+    rng = random.Random(seed)
+    words = [phonemes for phonemes in dictionary.values() if phonemes]
+    notes = [{'key': 0, 'duration': 0.5, 'slur': False, 'phonemes': ['SP']}]
+    length = 0.5
+    while length < seconds:
+        note = {'key': rng.randint(55, 75), 'duration': rng.choice([0.125, 0.25, 0.5, 1.]), 'slur': False}
+        if rng.random() < 0.2:
+            note['slur'] = True
+        else:
+            note['phonemes'] = rng.choice(words)
+        notes.append(note)
+        length += note['duration']
+    return notes
+
+
+def summarize(values: list) -> dict:
+    """
+    Count, mean, maximum and percentiles of a list of latencies in seconds.
+    """
+    values = np.array(values, dtype=np.float64)
+    res = {
+        'count': int(values.shape[0]),
+        'mean': float(values.mean()),
+        'max': float(values.max())
+    }
+    for p, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+        res[f'p{p}'] = float(value)
+    return res
+
+
+def run_concurrently(job, count: int, concurrency: int) -> dict:
+    """
+    Call `job(i)` for i in range(count) on `concurrency` threads. Every call returns a dict of stage latencies.
+    """
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        timings = list(executor.map(job, range(count)))
+    wall_time = time.perf_counter() - start
+    return {
+        'requests': count,
+        'concurrency': concurrency,
+        'wall_time': wall_time,
+        'rps': count / wall_time,
+        'stages': {
+            stage: summarize([timing[stage] for timing in timings if stage in timing])
+            for stage in dict.fromkeys(stage for timing in timings for stage in timing)
+        }
+    }
+
+
+def _peak_rss(pid: int = None):
+    """
+    Peak resident set size in MB of this process, or of another process on Linux, or None if unknown.
+    """
+    if pid is not None:
+        try:
+            with open(f'/proc/{pid}/status', 'r') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+        return None
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def benchmark_rhythm(config: dict, dictionary: dict, phoneme_index: dict, args) -> dict:
+    vowels = utils.dictionary_to_vowels(dictionary)
+    phrases = [make_notes(dictionary, args.duration, seed=i) for i in range(args.requests)]
+    utils.session_pool.get(config['rhythmizer']['filename'], config['providers'])
+
+    def job(i):
+        start = time.perf_counter()
+        with metrics.collect() as timings:
+            synthesis.predict_rhythm(phrases[i], phoneme_index, vowels, config)
+        return dict(timings, total=time.perf_counter() - start)
+
+    res = run_concurrently(job, args.requests, args.concurrency)
+    res['peak_rss'] = _peak_rss()
+    return res
+
+
+def benchmark_synthesis(config: dict, dictionary: dict, phoneme_index: dict, acoustic: str, args) -> dict:
+    requests = [make_request(dictionary, args.duration, seed=i) for i in range(args.requests)]
+    for request in requests:
+        request['speedup'] = args.speedup
+    utils.session_pool.get(acoustic, config['providers'])
+    utils.session_pool.get(config['vocoder']['filename'], config['providers'],
+                           force_on_cpu=config['vocoder']['force_on_cpu'])
+
+    def job(i):
+        start = time.perf_counter()
+        with metrics.collect() as timings:
+            synthesis.run_synthesis(requests[i], phoneme_index, acoustic, config)
+        return dict(timings, total=time.perf_counter() - start)
+
+    res = run_concurrently(job, args.requests, args.concurrency)
+    res['peak_rss'] = _peak_rss()
+    return res
+
+
+def _call(url: str, body: dict = None):
+    data = json.dumps(body).encode(encoding='utf-8') if body is not None else None
+    with urllib.request.urlopen(urllib.request.Request(url, data=data), timeout=600) as response:
+        raw = response.read()
+    return json.loads(raw) if body is not None else raw
+
+
+def benchmark_http(config: dict, dictionary: dict, model: str, args, work_dir: str) -> dict:
+    server = None
+    url = args.url
+    if url is None:
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        config = dict(config, server=dict(config['server'], port=port, cache_dir=os.path.join(work_dir, 'cache')))
+        config_path = os.path.join(work_dir, 'benchmark.yaml')
+        with open(config_path, 'w', encoding='utf8') as f:
+            yaml.safe_dump(config, f)
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(SERVER_ROOT, 'server.py'), '--config', config_path],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        url = f'http://127.0.0.1:{port}'
+    try:
+        for _ in range(600):
+            try:
+                _call(f'{url}/version')
+                break
+            except OSError:
+                if server is not None and server.poll() is not None:
+                    raise RuntimeError('Benchmark server exited during startup.')
+                time.sleep(0.1)
+        requests = [make_request(dictionary, args.duration, seed=i) for i in range(args.requests)]
+
+        def job(i):
+            request = dict(requests[i], model=model, speedup=args.speedup)
+            start = time.perf_counter()
+            token = _call(f'{url}/submit', request)['token']
+            submitted = time.perf_counter()
+            status = None
+            while status not in ['HIT_CACHE', 'FINISHED']:
+                status = _call(f'{url}/query', {'token': token, 'wait': 30, 'status': status})['status']
+                if status in ['FAILED', 'CANCELLED', 'NOT_FOUND']:
+                    raise RuntimeError(f'Task \'{token}\' ended with status {status}.')
+            finished = time.perf_counter()
+            _call(f'{url}/download?token={token}')
+            downloaded = time.perf_counter()
+            return {
+                'submit': submitted - start,
+                'wait': finished - submitted,
+                'download': downloaded - finished,
+                'total': downloaded - start
+            }
+
+        res = run_concurrently(job, args.requests, args.concurrency)
+        res['peak_rss'] = _peak_rss(server.pid) if server is not None else None
+        return res
+    finally:
+        if server is not None:
+            server.send_signal(signal.SIGINT if os.name == 'posix' else signal.SIGTERM)
+            server.wait()
+
+
+def _run_segmentation_mode(mode: str, config: dict, phoneme_index: dict, request: dict, acoustic: str) -> dict:
+    utils.session_pool.get(acoustic, config['providers'])
+    utils.session_pool.get(config['vocoder']['filename'], config['providers'],
+                           force_on_cpu=config['vocoder']['force_on_cpu'])
+    start = time.perf_counter()
+    if mode == 'single':
+        samples = synthesis.run_synthesis(request, phoneme_index, acoustic, config).shape[0]
+    else:
+        executor = ThreadPoolExecutor(config['segmentation']['workers'])
+        samples = sum(
+            piece.shape[0]
+            for piece in synthesis.segmented_synthesis(request, phoneme_index, acoustic, config, executor=executor)
+        )
+        executor.shutdown()
+    return {
+        'wall_time': time.perf_counter() - start,
+        'audio_length': samples / config['vocoder']['sample_rate'],
+        'peak_rss': _peak_rss()
+    }
+
+
+def benchmark_segmentation(config: dict, dictionary: dict, phoneme_index: dict, acoustic: str, args) -> dict:
+    if args.input is not None:
+        with open(args.input, 'r', encoding='utf8') as f:
+            request = json.load(f)
+    else:
+        request = make_request(dictionary, args.duration)
+    request['speedup'] = args.speedup
+    results = {}
+    for mode in ['single', 'segmented']:
+        # A fresh process per mode keeps the peak memory of one mode out of the other.
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results[mode] = executor.submit(
+                _run_segmentation_mode, mode, config, phoneme_index, request, acoustic
+            ).result()
+    return results
+
+
+def _resolve(path: str) -> str:
+    return path if os.path.isabs(path) else os.path.join(SERVER_ROOT, path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the DiffSinger inference engine')
+    parser.add_argument('scenario', type=str, choices=['rhythm', 'synthesis', 'http', 'segmentation'])
+    parser.add_argument('--config', type=str, required=False, default='default',
+                        help='name of a config in the configs directory or path to a YAML file')
+    parser.add_argument('--synthetic', action='store_true', help='use generated stand-in models')
+    parser.add_argument('--model', type=str, required=False, help='name of the acoustic model')
+    parser.add_argument('--requests', type=int, required=False, default=20)
+    parser.add_argument('--concurrency', type=int, required=False, default=1)
+    parser.add_argument('--duration', type=float, required=False, default=30.,
+                        help='length in seconds of every generated song or phrase')
+    parser.add_argument('--speedup', type=int, required=False)
+    parser.add_argument('--input', type=str, required=False, help='JSON request used by the segmentation scenario')
+    parser.add_argument('--url', type=str, required=False, help='server used by the http scenario')
+    parser.add_argument('--output', type=str, required=False, help='also write the results to this file')
+    args = parser.parse_args()
+    if not args.synthetic and args.model is None:
+        parser.error('--model is required unless --synthetic is given')
+
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.config.endswith(('.yaml', '.yml')):
+        cfg_path = args.config
+    else:
+        cfg_path = os.path.join(CONFIG_ROOT, f'{args.config}.yaml')
+    config = utils.load_configs(cfg_path)
+    dict_path = _resolve(config['dictionary']['filename'])
+    config['dictionary']['filename'] = dict_path
+    dictionary = utils.load_dictionary(dict_path)
+    phoneme_index = utils.phonemes_to_index(
+        utils.dictionary_to_phonemes(dictionary, config['dictionary']['reserved_tokens'])
+    )
+    if args.speedup is None:
+        args.speedup = config['acoustic']['speedup']
+
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as work_dir:
+        if args.synthetic:
+            paths = create_synthetic_models(work_dir, config['vocoder']['num_mel_bins'], config['vocoder']['hop_size'])
+            config['rhythmizer']['filename'] = paths['rhythmizer']
+            config['vocoder']['filename'] = paths['vocoder']
+            config['acoustic']['directory'] = work_dir
+            config['providers'] = [{'name': 'CPUExecutionProvider', 'options': {}}]
+            model = SYNTHETIC_MODEL
+        else:
+            config['rhythmizer']['filename'] = _resolve(config['rhythmizer']['filename'])
+            config['vocoder']['filename'] = _resolve(config['vocoder']['filename'])
+            config['acoustic']['directory'] = _resolve(config['acoustic']['directory'])
+            model = args.model
+        acoustic = os.path.join(config['acoustic']['directory'], f'{model}.onnx')
+
+        if args.scenario == 'rhythm':
+            result = benchmark_rhythm(config, dictionary, phoneme_index, args)
+        elif args.scenario == 'synthesis':
+            result = benchmark_synthesis(config, dictionary, phoneme_index, acoustic, args)
+        elif args.scenario == 'http':
+            result = benchmark_http(config, dictionary, model, args, work_dir)
+        else:
+            result = benchmark_segmentation(config, dictionary, phoneme_index, acoustic, args)
+
+    result = {
+        'scenario': args.scenario,
+        'synthetic': args.synthetic,
+        'model': model,
+        'duration': args.duration,
+        'speedup': args.speedup,
+        'results': result
+    }
+    print(json.dumps(result, indent=2))
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf8') as f:
+            json.dump(result, f, indent=2)
@@ -0,0 +1,229 @@
+import collections
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+import audio
+import utils
+
+# Temporary files left untouched for this many seconds are leftovers of interrupted writes.
+PART_GRACE_PERIOD = 3600
+
+
+class MemoryCache:
+    """
+    Small in-memory LRU mapping for results that are cheap to keep but costly to recompute.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._mutex = threading.Lock()
+
+    def get(self, key: str):
+        with self._mutex:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key: str, value):
+        with self._mutex:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while 0 < self.max_entries < len(self._entries):
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._mutex:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+class FileCache:
+    """
+    Size-bounded directory of cached files named `{key}.{extension}`.
+
+    An in-memory index is built from the directory at startup, so lookups never touch the file system.
+    Once the total size exceeds `max_bytes` or the entry count exceeds `max_entries` (0 for unlimited),
+    entries are evicted by the given policy: 'lru' (least recently used) or 'lfu' (least frequently used).
+    Files are written to a temporary path first and renamed into place by `commit()`, so a half-written
+    file is never visible under its final name.
+
+    A directory must have a single writing process at a time. Another process may add files safely, but they
+    stay invisible to the index of this one until it restarts, and each process enforces the size limits
+    against its own index only.
+    """
+
+    def __init__(self, directory: str, extension: str, max_bytes: int = 0, max_entries: int = 0,
+                 policy: str = 'lru'):
+        assert policy in ['lru', 'lfu'], f'Unknown cache policy \'{policy}\'.'
+        self.directory = directory
+        self.extension = extension
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._index = collections.OrderedDict()
+        self._counts = {}
+        self._size = 0
+        self._mutex = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        suffix = f'.{extension}'
+        entries = []
+        for entry in os.scandir(directory):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith('.part'):
+                # Leftover of an interrupted write, unless another process is still writing it
+                if time.time() - entry.stat().st_mtime > PART_GRACE_PERIOD:
+                    os.remove(entry.path)
+            elif entry.name.endswith(suffix):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-len(suffix)], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._counts[key] = 0
+            self._size += size
+        with self._mutex:
+            self._evict()
+        logging.info(f'Cache \'{directory}\' loaded with {len(self._index)} entries '
+                     f'({self._size / 1024 / 1024:.1f} MB)')
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.{self.extension}')
+
+    def contains(self, key: str) -> bool:
+        with self._mutex:
+            return key in self._index
+
+    def lookup(self, key: str, count: bool = True):
+        """
+        Return the path of a cached entry and mark it as used, or None on a miss.
+        Internal probes pass `count=False` to stay out of the hit and miss counters.
+        """
+        with self._mutex:
+            if key not in self._index:
+                if count:
+                    self.misses += 1
+                return None
+            if count:
+                self.hits += 1
+            self._index.move_to_end(key)
+            self._counts[key] += 1
+            return self.path(key)
+
+    def temp_path(self, key: str) -> str:
+        return f'{self.path(key)}.{utils.random_string(8)}.part'
+
+    def commit(self, key: str, temp_path: str):
+        """
+        Atomically move a completely written temporary file into the cache.
+        """
+        path = self.path(key)
+        os.replace(temp_path, path)
+        size = os.path.getsize(path)
+        with self._mutex:
+            self._size += size - self._index.pop(key, 0)
+            self._index[key] = size
+            self._counts[key] = self._counts.get(key, 0) + 1
+            self._evict(keep=key)
+
+    def discard(self, key: str):
+        with self._mutex:
+            self._drop(key)
+
+    def stats(self) -> dict:
+        with self._mutex:
+            return {
+                'entries': len(self._index),
+                'bytes': self._size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+    def _evict(self, keep: str = None):
+        # The entry just committed (`keep`) is never evicted, or a new entry would lose to any older entry
+        # looked up more than once under the LFU policy before it could ever be read.
+        while len(self._index) > 1 and (
+                0 < self.max_bytes < self._size or 0 < self.max_entries < len(self._index)):
+            candidates = (k for k in self._index if k != keep)
+            if self.policy == 'lfu':
+                # Ties are broken by recency thanks to the insertion order of the index.
+                key = min(candidates, key=self._counts.__getitem__)
+            else:
+                key = next(candidates)
+            self._drop(key)
+            self.evictions += 1
+
+    def _drop(self, key: str):
+        if key not in self._index:
+            return
+        self._size -= self._index.pop(key)
+        self._counts.pop(key)
+        try:
+            os.remove(self.path(key))
+        except OSError as e:
+            logging.warning(f'Failed to remove cache file of \'{key}\': {e}')
+
+
+class AudioCache(FileCache):
+    """
+    Cache of synthesized audio files, keyed by task token and stored in one of `audio.FORMATS`.
+    """
+
+    def __init__(self, directory: str, audio_format: str = 'wav', max_bytes: int = 0, max_entries: int = 0,
+                 policy: str = 'lru'):
+        assert audio_format in audio.FORMATS, f'Unknown audio format \'{audio_format}\'.'
+        super().__init__(directory, audio.FORMATS[audio_format]['extension'],
+                         max_bytes=max_bytes, max_entries=max_entries, policy=policy)
+        self.format = audio_format
+
+
+class ArrayCache(FileCache):
+    """
+    Cache of NumPy arrays stored as .npy files, optionally converted to another dtype on disk.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 0, max_entries: int = 0, policy: str = 'lru',
+                 dtype=None):
+        super().__init__(directory, 'npy', max_bytes=max_bytes, max_entries=max_entries, policy=policy)
+        self.dtype = dtype
+
+    def get(self, key: str):
+        path = self.lookup(key)
+        if path is None:
+            return None
+        try:
+            return np.load(path, mmap_mode='r').astype(np.float32)
+        except (OSError, ValueError):
+            self.discard(key)
+            return None
+
+    def put(self, key: str, array: np.ndarray):
+        temp_path = self.temp_path(key)
+        with open(temp_path, 'wb') as f:
+            np.save(f, array if self.dtype is None else array.astype(self.dtype))
+        self.commit(key, temp_path)
+
+
+class MelCache(ArrayCache):
+    """
+    Cache of mel-spectrograms, stored compactly as float16.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 0, max_entries: int = 0, policy: str = 'lru'):
+        super().__init__(directory, max_bytes=max_bytes, max_entries=max_entries, policy=policy, dtype=np.float16)
@@ -0,0 +1,120 @@
+"""
+Durable record of the tasks of this node, so that queued work survives a restart.
+
+Every state transition of a task is appended to an SQLite database in WAL mode. When the server starts, it
+replays the journal: tasks whose last event is SUBMITTED or RUNNING are queued again and recent failures are
+reported again. The RUNNING events of a task since it last ended count its interrupted attempts, so that
+a task which takes the server down every time it runs can be given up instead of replayed forever. Compaction
+drops the events of tasks that finished, were cancelled or failed longer than the failure TTL ago.
+"""
+import json
+import sqlite3
+import threading
+import time
+
+FINAL_EVENTS = ('FINISHED', 'CANCELLED')
+END_EVENTS = FINAL_EVENTS + ('FAILED',)
+
+
+class TaskJournal:
+    def __init__(self, path: str, failure_ttl: float = 0.):
+        self.path = path
+        self.failure_ttl = failure_ttl
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        # Committed events survive a crash of the process; only a power loss may lose the last ones.
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS events ('
+            'seq INTEGER PRIMARY KEY AUTOINCREMENT, token TEXT NOT NULL, status TEXT NOT NULL, '
+            'data TEXT, time REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS events_token ON events (token)')
+        self._mutex = threading.Lock()
+
+    def _append(self, token: str, status: str, data=None):
+        with self._mutex:
+            self._conn.execute(
+                'INSERT INTO events (token, status, data, time) VALUES (?, ?, ?, ?)',
+                (token, status, None if data is None else json.dumps(data), time.time())
+            )
+
+    def submitted(self, token: str, task: dict):
+        """
+        Record a new task. `task` must be JSON-serializable and hold everything needed to queue it again.
+        """
+        self._append(token, 'SUBMITTED', task)
+
+    def started(self, token: str):
+        self._append(token, 'RUNNING')
+
+    def finished(self, token: str):
+        self._append(token, 'FINISHED')
+
+    def failed(self, token: str, message: str):
+        self._append(token, 'FAILED', message)
+
+    def cancelled(self, token: str):
+        self._append(token, 'CANCELLED')
+
+    def _last_events(self) -> list:
+        # Must be called with the mutex held
+        return self._conn.execute(
+            'SELECT e.token, e.status, e.data, e.time FROM events e '
+            'JOIN (SELECT MAX(seq) AS seq FROM events GROUP BY token) l ON e.seq = l.seq ORDER BY e.seq'
+        ).fetchall()
+
+    def unfinished(self) -> list:
+        """
+        Return (token, task, attempts) of the tasks that were queued or running, in order of submission,
+        where `attempts` is the number of times the task started running without ever ending.
+        """
+        tasks = []
+        with self._mutex:
+            tokens = [token for token, status, _, _ in self._last_events() if status in ('SUBMITTED', 'RUNNING')]
+            for token in tokens:
+                row = self._conn.execute(
+                    'SELECT seq, data FROM events WHERE token = ? AND status = ? ORDER BY seq DESC LIMIT 1',
+                    (token, 'SUBMITTED')
+                ).fetchone()
+                if row is None:
+                    continue
+                attempts = self._conn.execute(
+                    'SELECT COUNT(*) FROM events WHERE token = ? AND status = ? AND seq > '
+                    '(SELECT COALESCE(MAX(seq), 0) FROM events WHERE token = ? AND status IN (?, ?, ?))',
+                    (token, 'RUNNING', token, *END_EVENTS)
+                ).fetchone()[0]
+                tasks.append((row[0], token, json.loads(row[1]), attempts))
+        return [(token, task, attempts) for _, token, task, attempts in sorted(tasks, key=lambda t: t[0])]
+
+    def failures(self) -> list:
+        """
+        Return (token, message, time) of the failures that are not older than the failure TTL.
+        """
+        deadline = time.time() - self.failure_ttl if self.failure_ttl > 0 else 0.
+        with self._mutex:
+            events = self._last_events()
+        return [
+            (token, json.loads(data), t) for token, status, data, t in events if status == 'FAILED' and t >= deadline
+        ]
+
+    def compact(self) -> int:
+        """
+        Remove the events of tasks that finished, were cancelled or failed before the failure TTL,
+        and return the number of tasks removed.
+        """
+        deadline = time.time() - self.failure_ttl if self.failure_ttl > 0 else 0.
+        with self._mutex:
+            self._conn.execute('BEGIN IMMEDIATE')
+            tokens = [
+                token for token, status, _, t in self._last_events()
+                if status in FINAL_EVENTS or (status == 'FAILED' and t < deadline)
+            ]
+            self._conn.executemany('DELETE FROM events WHERE token = ?', [(token,) for token in tokens])
+            self._conn.execute('COMMIT')
+            self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return len(tokens)
+
+    def close(self):
+        with self._mutex:
+            self._conn.close()
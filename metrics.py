@@ -0,0 +1,205 @@
+"""
+Counters, gauges and histograms exposed in the Prometheus text format by /metrics.
+
+Stages of the synthesis pipeline are timed with `stage(name)`. Besides feeding the stage histogram,
+the time of every stage is added to the timing breakdown of the current task if one is being collected
+with `collect()`. The breakdown lives in a context variable, so it follows the task across threads as
+long as work is submitted with a copied context (see `run_in_context`).
+"""
+import contextlib
+import contextvars
+import threading
+import time
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60., 120.)
+
+_timings = contextvars.ContextVar('timings', default=None)
+_timings_mutex = threading.Lock()
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._mutex = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        assert set(labels) == set(self.labelnames), f'Labels of \'{self.name}\' are {self.labelnames}.'
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> list:
+        """
+        Return a list of (suffix, labels, value) samples.
+        """
+        raise NotImplementedError()
+
+    def render(self) -> str:
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}'
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing value. If `fn` is given, values are read from it on every scrape instead:
+    it returns a dict mapping label value tuples to values.
+    """
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), fn=None):
+        super().__init__(name, documentation, labelnames)
+        self.fn = fn
+        self._values = {}
+
+    def inc(self, amount: float = 1., **labels):
+        key = self._key(labels)
+        with self._mutex:
+            self._values[key] = self._values.get(key, 0.) + amount
+
+    def samples(self) -> list:
+        if self.fn is not None:
+            values = self.fn()
+        else:
+            with self._mutex:
+                values = dict(self._values)
+        return [('', dict(zip(self.labelnames, key)), value) for key, value in sorted(values.items())]
+
+
+class Gauge(Counter):
+    """
+    Value that can go up and down.
+    """
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._mutex:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._mutex:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self) -> list:
+        with self._mutex:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        samples = []
+        for key, (counts, total) in sorted(values.items()):
+            labels = dict(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets, counts):
+                samples.append(('_bucket', dict(labels, le=_format_value(bound)), count))
+            samples.append(('_count', labels, counts[-1]))
+            samples.append(('_sum', labels, total))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._mutex = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._mutex:
+            assert metric.name not in self._metrics, f'Metric \'{metric.name}\' is already registered.'
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        with self._mutex:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.register(Histogram(
+    'diffsinger_stage_seconds', 'Time spent in each stage of the synthesis pipeline.', ('stage',)
+))
+SESSION_LOAD_SECONDS = registry.register(Histogram(
+    'diffsinger_session_load_seconds', 'Time spent creating inference sessions.', ('model',)
+))
+TASKS = registry.register(Counter(
+    'diffsinger_tasks_total', 'Synthesis tasks by final status.', ('status',)
+))
+REJECTIONS = registry.register(Counter(
+    'diffsinger_rejections_total', 'Requests refused by admission control.', ('reason',)
+))
+
+
+@contextlib.contextmanager
+def collect():
+    """
+    Collect the time spent in every stage run within this block into the yielded dict.
+    """
+    timings = {}
+    reset = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(reset)
+
+
+def record(name: str, elapsed: float):
+    """
+    Record `elapsed` seconds spent in a stage, both in the stage histogram and in the current breakdown.
+    """
+    STAGE_SECONDS.observe(elapsed, stage=name)
+    timings = _timings.get()
+    if timings is not None:
+        with _timings_mutex:
+            timings[name] = timings.get(name, 0.) + elapsed
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def run_in_context(executor, fn, *args):
+    """
+    Submit `fn` to `executor` so that it runs in a copy of the current context.
+    """
+    return executor.submit(contextvars.copy_context().run, fn, *args)
@@ -0,0 +1,240 @@
+"""
+Offline batch rendering of many songs without the HTTP server.
+
+Requests in the format of /submit are read from a directory of .json files or from a JSONL file, and the audio
+of each song is written into an output directory. Songs go through the steps of `synthesis.run_synthesis` as
+a pipeline: preprocessing, the acoustic model, the vocoder and file encoding each run in their own thread and
+hand songs over through bounded queues, so that the vocoder works on one song while diffusion runs on the next.
+
+Results are stored in an audio cache under their task token, like the server does, so a run that is interrupted
+resumes where it stopped. The cache is the one of the server (server.cache_dir) by default, so that songs already
+rendered by the server are not rendered again, but a cache directory must have a single writer: stop the server
+first, or pass --cache-dir to render into a directory of its own.
+A throughput summary is printed as JSON at the end.
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+
+import numpy as np
+import soundfile
+
+import audio
+import caching
+import synthesis
+import utils
+
+SERVER_ROOT = os.path.dirname(os.path.abspath(__file__))
+CONFIG_ROOT = os.path.join(SERVER_ROOT, 'configs')
+STAGES = ['preprocess', 'acoustic', 'vocoder', 'encode']
+
+logging.basicConfig(level='INFO',
+                    format="%(asctime)s - %(levelname)-7s: %(message)s",
+                    datefmt="%Y-%m-%d %H:%M:%S")
+
+
+def load_requests(path: str) -> list:
+    """
+    Return (name, request) pairs read from a directory of .json files, named after the files, or from a JSONL
+    file, named by their "name" field or else by their line number.
+    """
+    if os.path.isdir(path):
+        requests = []
+        for filename in sorted(os.listdir(path)):
+            if filename.endswith('.json'):
+                with open(os.path.join(path, filename), 'r', encoding='utf8') as f:
+                    requests.append((filename[:-5], json.load(f)))
+        return requests
+    requests = []
+    with open(path, 'r', encoding='utf8') as f:
+        for i, line in enumerate(f):
+            if line.strip():
+                request = json.loads(line)
+                requests.append((request.get('name', f'{i:05d}'), request))
+    return requests
+
+
+class Pipeline:
+    """
+    Renders songs in four stages, each in its own thread, connected by queues of at most `queue_size` songs.
+    A song that fails in any stage is logged and dropped without stopping the others.
+    """
+
+    def __init__(self, config: dict, bindings: utils.ModelBindings, audio_cache: caching.AudioCache,
+                 output_dir: str, queue_size: int = 2):
+        self.config = config
+        self.bindings = bindings
+        self.audio_cache = audio_cache
+        self.output_dir = output_dir
+        self.queue_size = queue_size
+        self.busy = {name: 0. for name in STAGES}
+        self.rendered = []
+        self.cached = []
+        self.failed = []
+        self.audio_seconds = 0.
+        self._mutex = threading.Lock()
+
+    def run(self, requests: list) -> dict:
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in STAGES]
+        steps = [self._preprocess, self._acoustic, self._vocoder, self._encode]
+        threads = [
+            threading.Thread(
+                target=self._work, args=(name, step, queues[i], queues[i + 1] if i + 1 < len(queues) else None),
+                name=name, daemon=True
+            )
+            for i, (name, step) in enumerate(zip(STAGES, steps))
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for name, request in requests:
+            queues[0].put({'name': name, 'request': request})
+        queues[0].put(None)
+        for thread in threads:
+            thread.join()
+        return self._summary(len(requests), time.perf_counter() - start)
+
+    def _work(self, stage: str, step, inbox: queue.Queue, outbox: queue.Queue):
+        while True:
+            song = inbox.get()
+            if song is None:
+                if outbox is not None:
+                    outbox.put(None)
+                return
+            start = time.perf_counter()
+            try:
+                # Songs found in the cache only need to be copied by the last stage.
+                if 'path' not in song or stage == 'encode':
+                    step(song)
+            except Exception as e:
+                logging.error(f'Song \'{song["name"]}\' failed in stage {stage}: {e}')
+                with self._mutex:
+                    self.failed.append(song['name'])
+                continue
+            finally:
+                with self._mutex:
+                    self.busy[stage] += time.perf_counter() - start
+            if outbox is not None:
+                outbox.put(song)
+
+    def _preprocess(self, song: dict):
+        request = dict(song['request'])
+        request.setdefault('speedup', self.config['acoustic']['speedup'])
+        binding = self.bindings.get(request.get('model'))
+        if binding is None:
+            raise ValueError(f'Unknown model \'{request.get("model")}\'.')
+        table, _ = binding
+        song['token'], (tokens, durations, f0) = synthesis.canonicalize_request(request, table.index, self.config)
+        cache_file = self.audio_cache.lookup(song['token'])
+        if cache_file is not None:
+            song['path'] = cache_file
+            return
+        song.update(
+            acoustic=os.path.join(self.bindings.acoustic_root, f'{request["model"]}.onnx'),
+            speedup=int(request['speedup']), tokens=tokens, durations=durations, f0=f0
+        )
+
+    def _acoustic(self, song: dict):
+        song['mel'] = synthesis.acoustic_infer(
+            model=song['acoustic'], providers=self.config['providers'], tokens=song.pop('tokens'),
+            durations=song.pop('durations'), f0=song['f0'], speedup=np.array(song['speedup'], dtype=np.int64)
+        )
+
+    def _vocoder(self, song: dict):
+        song['waveform'] = synthesis.vocoder_infer(
+            model=self.config['vocoder']['filename'], providers=self.config['providers'], mel=song.pop('mel'),
+            f0=song.pop('f0'), force_on_cpu=self.config['vocoder']['force_on_cpu']
+        )[0]
+
+    def _encode(self, song: dict):
+        audio_format = audio.FORMATS[self.audio_cache.format]
+        if 'path' in song:
+            with self._mutex:
+                self.cached.append(song['name'])
+        else:
+            waveform = song.pop('waveform')
+            temp_file = self.audio_cache.temp_path(song['token'])
+            soundfile.write(temp_file, waveform, self.config['vocoder']['sample_rate'],
+                            format=audio_format['format'], subtype=audio_format['subtype'])
+            self.audio_cache.commit(song['token'], temp_file)
+            song['path'] = self.audio_cache.path(song['token'])
+            with self._mutex:
+                self.rendered.append(song['name'])
+                self.audio_seconds += waveform.shape[0] / self.config['vocoder']['sample_rate']
+        shutil.copyfile(song['path'], os.path.join(self.output_dir, f'{song["name"]}.{audio_format["extension"]}'))
+        logging.info(f'Song \'{song["name"]}\' written')
+
+    def _summary(self, count: int, wall: float) -> dict:
+        return {
+            'songs': count,
+            'rendered': len(self.rendered),
+            'cached': len(self.cached),
+            'failed': sorted(self.failed),
+            'wall_seconds': wall,
+            'audio_seconds': self.audio_seconds,
+            'realtime_factor': self.audio_seconds / wall if wall > 0 else 0.,
+            'songs_per_minute': 60 * len(self.rendered) / wall if wall > 0 else 0.,
+            # Share of the wall time each stage was busy; the busiest stage bounds the throughput.
+            'stages': {
+                name: {'busy_seconds': busy, 'utilization': busy / wall if wall > 0 else 0.}
+                for name, busy in self.busy.items()
+            }
+        }
+
+
+def _resolve(path: str) -> str:
+    return path if os.path.isabs(path) else os.path.join(SERVER_ROOT, path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render many songs with the DiffSinger inference engine')
+    parser.add_argument('input', type=str, help='directory of JSON requests or JSONL file, in the format of /submit')
+    parser.add_argument('output', type=str, help='directory the audio files are written into')
+    parser.add_argument('--config', type=str, required=False, default='default',
+                        help='name of a config in the configs directory or path to a YAML file')
+    parser.add_argument('--cache-dir', type=str, required=False, default=None,
+                        help='audio cache directory, server.cache_dir by default; must not be in use by a server')
+    parser.add_argument('--queue-size', type=int, required=False, default=2,
+                        help='songs waiting between two stages at most')
+    args = parser.parse_args()
+
+    if args.config.endswith(('.yaml', '.yml')):
+        cfg_path = args.config
+    else:
+        cfg_path = os.path.join(CONFIG_ROOT, f'{args.config}.yaml')
+    config = utils.load_configs(cfg_path)
+    logging.info(f'Using config from \'{cfg_path}\'')
+    for section in ['dictionary', 'rhythmizer', 'vocoder']:
+        config[section]['filename'] = _resolve(config[section]['filename'])
+    assert os.path.exists(config['vocoder']['filename']), 'Vocoder model not found. Please check your configuration.'
+    sessions_config = config['sessions']
+    utils.session_pool.configure(
+        max_count=sessions_config['max_count'],
+        max_memory=sessions_config['max_memory'] * 1024 * 1024,
+        intra_op_num_threads=sessions_config['intra_op_threads'],
+        inter_op_num_threads=sessions_config['inter_op_threads']
+    )
+    cache_config = config['server']['cache']
+    song_cache = caching.AudioCache(
+        args.cache_dir or _resolve(config['server']['cache_dir']), audio_format=cache_config['format'],
+        max_bytes=cache_config['max_size'] * 1024 * 1024, max_entries=cache_config['max_entries'],
+        policy=cache_config['policy']
+    )
+    os.makedirs(args.output, exist_ok=True)
+
+    songs = load_requests(args.input)
+    logging.info(f'Rendering {len(songs)} songs into \'{args.output}\'')
+    pipeline = Pipeline(
+        config, utils.ModelBindings(config, _resolve(config['acoustic']['directory']), SERVER_ROOT), song_cache,
+        args.output, queue_size=args.queue_size
+    )
+    try:
+        summary = pipeline.run(songs)
+    finally:
+        utils.session_pool.clear()
+    print(json.dumps(summary, indent=2))
@@ -0,0 +1,167 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+
+class _Job:
+    def __init__(self, future: Future, fn, args: tuple, cost: float, start_tag: float):
+        self.future = future
+        self.fn = fn
+        self.args = args
+        self.cost = cost
+        self.start_tag = start_tag
+
+
+class FairScheduler:
+    """
+    Executor that runs tasks by weighted fair queuing instead of FIFO.
+
+    Each client has a virtual clock that advances by `cost / weight` for every task it submits, where the
+    weight comes from the priority class of the task. Tasks run in order of their virtual finish time, so
+    every client gets a share of the workers proportional to its weight no matter how many tasks it queues,
+    and cheap tasks overtake expensive ones queued at the same time.
+    """
+
+    def __init__(self, max_workers: int, weights: dict, default_priority: str):
+        assert default_priority in weights, f'Unknown default priority \'{default_priority}\'.'
+        self.max_workers = max_workers
+        self.weights = weights
+        self.default_priority = default_priority
+        self._heap = []
+        self._jobs = {}
+        self._counter = itertools.count()
+        self._virtual_time = 0.
+        self._finish_tags = {}
+        self._throughput = None
+        self._cond = threading.Condition()
+        for i in range(max_workers):
+            threading.Thread(target=self._work, name=f'scheduler-{i}', daemon=True).start()
+
+    def submit(self, fn, *args, client: str = '', priority: str = None, cost: float = 1.) -> Future:
+        if priority is None:
+            priority = self.default_priority
+        if priority not in self.weights:
+            raise ValueError(f'Unknown priority \'{priority}\'.')
+        future = Future()
+        with self._cond:
+            start_tag = max(self._virtual_time, self._finish_tags.get(client, 0.))
+            finish_tag = start_tag + cost / self.weights[priority]
+            self._finish_tags[client] = finish_tag
+            job = _Job(future, fn, args, cost, start_tag)
+            heapq.heappush(self._heap, (finish_tag, next(self._counter), job))
+            self._jobs[future] = job
+            self._cond.notify()
+        future.add_done_callback(self._forget)
+        return future
+
+    def pending(self) -> int:
+        """
+        Return the number of queued tasks. Cancelled tasks are not counted, although they stay in the heap
+        until a worker pops and drops them.
+        """
+        with self._cond:
+            return len(self._jobs)
+
+    def _forget(self, future: Future):
+        # Only a cancelled future can still be queued when it is done.
+        with self._cond:
+            self._jobs.pop(future, None)
+
+    def queue_info(self, future: Future):
+        """
+        Return the position of a queued task (0 is next) and its estimated start time in seconds from now,
+        or None if the task is not queued. The estimate is None until a task has been measured.
+        """
+        with self._cond:
+            if future not in self._jobs:
+                return None
+            ahead = [job for _, _, job in sorted(self._heap, key=lambda entry: entry[:2]) if job.future in self._jobs]
+            position = ahead.index(self._jobs[future])
+            eta = None
+            if self._throughput is not None:
+                eta = sum(job.cost for job in ahead[:position]) / (self._throughput * self.max_workers)
+            return position, eta
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                _, _, job = heapq.heappop(self._heap)
+                if self._jobs.pop(job.future, None) is None:
+                    continue
+                self._virtual_time = max(self._virtual_time, job.start_tag)
+                # Clients whose clocks fell behind are not ahead of anybody any more.
+                self._finish_tags = {
+                    client: tag for client, tag in self._finish_tags.items() if tag > self._virtual_time
+                }
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            start = time.monotonic()
+            try:
+                result = job.fn(*job.args)
+            except BaseException as e:
+                job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
+            elapsed = time.monotonic() - start
+            if elapsed > 0:
+                with self._cond:
+                    throughput = job.cost / elapsed
+                    if self._throughput is None:
+                        self._throughput = throughput
+                    else:
+                        self._throughput = 0.8 * self._throughput + 0.2 * throughput
+
+
+class QualityPolicy:
+    """
+    Load-aware choice of the speedup of preview tasks.
+
+    The load is the larger of the queue depth relative to `max_queue_depth` and the recent latency of tasks
+    (from submission to completion, smoothed) relative to `latency_slo`; a limit of 0 is ignored. While the
+    load exceeds 1, previews run with the speedup scaled up by the load, rounded up to a divisor of the
+    diffusion step count and capped at `max_speedup`. Previews run at the requested quality whenever the queue
+    is empty.
+    """
+
+    def __init__(self, scheduler: FairScheduler, diffusion_steps: int, max_speedup: int,
+                 max_queue_depth: int = 0, latency_slo: float = 0.):
+        self.scheduler = scheduler
+        self.max_speedup = max_speedup
+        self.max_queue_depth = max_queue_depth
+        self.latency_slo = latency_slo
+        self._speedups = [s for s in range(1, diffusion_steps + 1) if diffusion_steps % s == 0]
+        self._latency = None
+        self._mutex = threading.Lock()
+
+    def observe(self, latency: float):
+        with self._mutex:
+            if self._latency is None:
+                self._latency = latency
+            else:
+                self._latency = 0.8 * self._latency + 0.2 * latency
+
+    def load(self) -> float:
+        queue_depth = self.scheduler.pending()
+        if queue_depth == 0:
+            return 0.
+        load = 0.
+        if self.max_queue_depth > 0:
+            load = queue_depth / self.max_queue_depth
+        with self._mutex:
+            if self.latency_slo > 0 and self._latency is not None:
+                load = max(load, self._latency / self.latency_slo)
+        return load
+
+    def speedup(self, requested: int) -> int:
+        load = self.load()
+        if load <= 1:
+            return requested
+        candidates = [s for s in self._speedups if requested < s <= self.max_speedup]
+        for s in candidates:
+            if s >= requested * load:
+                return s
+        return candidates[-1] if candidates else requested
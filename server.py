@@ -2,22 +2,35 @@ import argparse
 import glob
 import json
 import logging
+import multiprocessing
 import os.path
+import socket
 import threading
+import time
 import urllib.parse
-from concurrent.futures import ThreadPoolExecutor
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
 import soundfile
 
+import audio
+import backends
+import caching
+import journal
+import metrics
+import scheduler
 import synthesis
 import utils
+import worker
 
 VERSION = '1.0.1'
 DATE = '2023-01-08'
 SERVER_ROOT = os.path.dirname(os.path.abspath(__file__))
 CONFIG_ROOT = os.path.join(SERVER_ROOT, 'configs')
-ACOUSTIC_ROOT = os.path.join(SERVER_ROOT, 'assets', 'acoustic')
+STREAM_BLOCK_SIZE = 64 * 1024
+FINAL_STATUSES = {'HIT_CACHE', 'FINISHED', 'FAILED', 'CANCELLED'}
+EVENTS_KEEPALIVE_INTERVAL = 15
+BACKEND_POLL_INTERVAL = 1
 
 logging.basicConfig(level='DEBUG',
                     format="%(asctime)s - %(levelname)-7s: %(message)s",
@@ -29,20 +42,43 @@ def version(request: BaseHTTPRequestHandler):
         'version': VERSION,
         'date': DATE
     }
-    request.send_response(200)
-    request.send_header('Content-Type', 'application/json')
-    request.end_headers()
-    request.wfile.write(json.dumps(v).encode('utf8'))
+    _send_json(request, v)
 
 
 def models(request: BaseHTTPRequestHandler):
     res = {
-        'models': [os.path.basename(file)[:-5] for file in glob.glob(os.path.join(ACOUSTIC_ROOT, '*.onnx'))]
+        'models': [os.path.basename(file)[:-5] for file in glob.glob(os.path.join(acoustic_root, '*.onnx'))]
+    }
+    _send_json(request, res)
+
+
+def stats(request: BaseHTTPRequestHandler):
+    res = {
+        'cache': audio_cache.stats()
     }
+    if segment_cache is not None:
+        res['segment_cache'] = segment_cache.stats()
+    if mel_cache is not None:
+        res['mel_cache'] = mel_cache.stats()
+    if rhythm_memo is not None:
+        res['rhythm_memo'] = rhythm_memo.stats()
+    if batchers is not None:
+        res['batching'] = {name: batcher.stats() for name, batcher in batchers.items()}
+    if backend is not None:
+        res['node'] = backend.node
+    _send_json(request, res)
+
+
+def export_metrics(request: BaseHTTPRequestHandler):
+    """
+    Counters and histograms in the Prometheus text exposition format.
+    """
+    body = metrics.registry.render().encode('utf8')
     request.send_response(200)
-    request.send_header('Content-Type', 'application/json')
+    request.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+    request.send_header('Content-Length', str(len(body)))
     request.end_headers()
-    request.wfile.write(json.dumps(res).encode('utf8'))
+    request.wfile.write(body)
 
 
 def rhythm(request: BaseHTTPRequestHandler):
@@ -74,10 +110,95 @@ def rhythm(request: BaseHTTPRequestHandler):
             }
           ]
         }
+    "model" optionally names an acoustic model whose dictionary and rhythmizer are used instead of the default ones.
+    """
+    request_body = json.loads(request.rfile.read(int(request.headers['Content-Length'])))
+    results = _predict_rhythm(request, request_body.get('model'), [request_body['notes']])
+    if results is None:
+        return
+    [(ph_seq, ph_dur)] = results
+    _send_json(request, _rhythm_result(ph_seq, ph_dur))
+
+
+def rhythm_batch(request: BaseHTTPRequestHandler):
+    """
+    Predict the rhythm of many phrases at once. Phrases take the same form as the body of /rhythm
+    and results are returned in the same order.
+
+    Example:
+        {
+          "phrases": [
+            {
+              "notes": [
+                {
+                  "key": 69,
+                  "duration": 0.5,
+                  "slur": false,
+                  "phonemes": [
+                    "sh",
+                    "a"
+                  ]
+                }
+              ]
+            },
+            {
+              "notes": [
+                {
+                  "key": 0,
+                  "duration": 0.5,
+                  "slur": false,
+                  "phonemes": [
+                    "AP"
+                  ]
+                }
+              ]
+            }
+          ]
+        }
+    "model" selects the dictionary and rhythmizer of all phrases as in /rhythm.
     """
     request_body = json.loads(request.rfile.read(int(request.headers['Content-Length'])))
-    ph_seq, ph_dur = synthesis.predict_rhythm(request_body['notes'], phoneme_list, vowels, config)
+    results = _predict_rhythm(
+        request, request_body.get('model'), [phrase['notes'] for phrase in request_body['phrases']]
+    )
+    if results is None:
+        return
     res = {
+        'phrases': [_rhythm_result(ph_seq, ph_dur) for ph_seq, ph_dur in results]
+    }
+    _send_json(request, res)
+
+
+def _predict_rhythm(request: BaseHTTPRequestHandler, model, phrases: list):
+    """
+    Predict the rhythm of phrases with the dictionary and rhythmizer of `model`, or the default ones if it is None.
+    Returns None after sending an error if the model or any phoneme is unknown.
+    """
+    if model is None:
+        table, rhythmizer = model_bindings.default_table, config['rhythmizer']['filename']
+    else:
+        binding = model_bindings.get(model)
+        if binding is None:
+            _send_json(request, {'message': f'Unknown model \'{model}\'.'}, code=400)
+            return None
+        table, rhythmizer = binding
+        if rhythmizer is None:
+            _send_json(request, {'message': f'Model \'{model}\' has no rhythmizer.'}, code=400)
+            return None
+    configs = dict(
+        config,
+        dictionary=dict(config['dictionary'], filename=table.filename, reserved_tokens=table.reserved_tokens),
+        rhythmizer=dict(config['rhythmizer'], filename=rhythmizer)
+    )
+    try:
+        return synthesis.predict_rhythm_batch(phrases, table.index, table.vowels, configs, memo=rhythm_memo)
+    except utils.PhonemeError as e:
+        _send_json(request, {'message': str(e)}, code=400)
+        return None
+
+
+def _rhythm_result(ph_seq: list, ph_dur: list) -> dict:
+    return {
         'phonemes': [
             {
                 'name': name,
@@ -86,10 +207,6 @@ def rhythm(request: BaseHTTPRequestHandler):
             for name, duration in zip(ph_seq, ph_dur)
         ]
     }
-    request.send_response(200)
-    request.send_header('Content-Type', 'application/json')
-    request.end_headers()
-    request.wfile.write(json.dumps(res).encode('utf8'))
 
 
 def submit(request: BaseHTTPRequestHandler):
@@ -117,181 +234,954 @@ def submit(request: BaseHTTPRequestHandler):
               440.0
             ]
           },
-          "speedup": 50
+          "speedup": 50,
+          "priority": "interactive",
+          "client": "editor-1",
+          "preview": true
         }
+    "priority" selects a class of scheduler.weights and "client" identifies the client for fair sharing
+    (defaults to the client address). With "preview", the task may run with a higher speedup while the server
+    is overloaded (see preview.adaptive); the draft is kept apart from full-quality results and is replaced by
+    the first full-quality render of the same request; a full-quality submission arriving while only a draft is
+    in flight is rendered right after the draft. None of them takes part in the task token.
+    Phonemes are looked up in the dictionary of the model (see `utils.ModelBindings`). The task token is a hash of
+    the frame-level inputs of the models (see `synthesis.request_token`), so equivalent requests share a task
+    and a cached result.
     """
     request_body = json.loads(request.rfile.read(int(request.headers['Content-Length'])))
+    priority = request_body.pop('priority', None)
+    client = request_body.pop('client', request.client_address[0])
+    preview = bool(request_body.pop('preview', False))
+    if priority is not None and priority not in pool.weights:
+        _send_json(request, {'message': f'Unknown priority \'{priority}\'.'}, code=400)
+        return
+    binding = model_bindings.get(request_body.get('model'))
+    if binding is None:
+        _send_json(request, {'message': f'Unknown model \'{request_body.get("model")}\'.'}, code=400)
+        return
+    table, _ = binding
     if 'speedup' not in request_body:
         request_body['speedup'] = config['acoustic']['speedup']
-    token = utils.request_to_token(request_body)
-    cache_file = os.path.join(cache, f'{token}.wav')
-    if os.path.exists(cache_file):
+    try:
+        valid_speedup = int(request_body['speedup']) > 0
+    except (TypeError, ValueError):
+        valid_speedup = False
+    if not valid_speedup:
+        _send_json(request, {'message': 'Speedup must be a positive integer.'}, code=400)
+        return
+    try:
+        token, inputs = synthesis.canonicalize_request(request_body, table.index, config)
+    except utils.PhonemeError as e:
+        _send_json(request, {'message': str(e)}, code=400)
+        return
+    speedup = int(request_body['speedup'])
+    if preview and quality is not None:
+        speedup = quality.speedup(speedup)
+    refusal = None
+    if audio_cache.lookup(token) is not None or _pull_shared(token):
         res = {
             'token': token,
             'status': 'HIT_CACHE'
         }
-    else:
-        mutex.acquire()
-        code = utils.random_string(4)
-        if token in tasks:
-            piles[token].append(code)
-        else:
-            if token in failures:
-                failures.pop(token)
-            tasks[token] = pool.submit(_execute, request_body, cache_file, token)
-            piles[token] = [code]
-        mutex.release()
+    elif speedup != int(request_body['speedup']) and (
+            audio_cache.lookup(_draft_key(token), count=False) is not None or _pull_shared(_draft_key(token))):
         res = {
             'token': token,
-            'status': 'SUBMITTED',
-            'code': code
+            'status': 'HIT_CACHE',
+            'draft': True
         }
-    request.send_response(200)
-    request.send_header('Content-Type', 'application/json')
-    request.end_headers()
-    request.wfile.write(json.dumps(res).encode('utf8'))
+    else:
+        code = utils.random_string(4)
+        entry = {'request': request_body, 'speedup': speedup, 'client': client, 'priority': priority}
+        task = None
+        owner = None
+        with mutex:
+            joined = _join_task(token, code, entry, table)
+            if not joined:
+                refusal = _admission_refusal(_estimate_memory(request_body))
+        if not joined and refusal is None and backend is not None:
+            # Claims go to the shared volume and are made outside the mutex.
+            owner = backend.claim(token, entry)
+        if not joined and refusal is None and (owner is None or owner == backend.node):
+            with mutex:
+                # Another request of the same token may have been queued during the claim.
+                if not _join_task(token, code, entry, table):
+                    task = _start_task(token, entry, table, inputs)
+                    piles[token] = [code]
+        if task is not None:
+            task.add_done_callback(_notify_status)
+        if refusal is not None:
+            reason, status_code, message = refusal
+            metrics.REJECTIONS.inc(reason=reason)
+            headers = {'Retry-After': str(config['admission']['retry_after'])} if status_code == 503 else None
+            _send_json(request, {'token': token, 'message': message}, code=status_code, headers=headers)
+            return
+        if owner is not None and owner != backend.node:
+            # Another node is synthesizing the same request; it can be queried and downloaded from any node.
+            res = {
+                'token': token,
+                'status': 'SUBMITTED',
+                'node': owner
+            }
+        else:
+            res = {
+                'token': token,
+                'status': 'SUBMITTED',
+                'code': code
+            }
+    _send_json(request, res)
+
+
+def _join_task(token: str, code: str, entry: dict, table: utils.PhonemeTable) -> bool:
+    """
+    Add a request with `code` to the task of `token` if one is in flight. Returns False if there is none.
+    Must be called with the mutex held.
+    """
+    if token not in tasks:
+        return False
+    if speedups[token][1] and entry['speedup'] == int(entry['request']['speedup']):
+        # Only a draft of the request is in flight: render the full-quality result after it.
+        followups.setdefault(token, (entry, table, []))[2].append(code)
+    else:
+        piles[token].append(code)
+    return True
+
+
+def _start_task(token: str, entry: dict, table: utils.PhonemeTable, inputs: tuple = None):
+    """
+    Queue a new task described by `entry`, the JSON-serializable dict of its request, effective speedup,
+    client and priority that is also recorded in the journal and the shared backend. `inputs` are the tensors
+    of the request from `synthesis.canonicalize_request`, if already computed.
+    Must be called with the mutex held; the caller registers the pile of the task.
+    """
+    request_body, speedup = entry['request'], entry['speedup']
+    if token in failures:
+        failures.pop(token)
+    if task_journal is not None:
+        task_journal.submitted(token, entry)
+    if config['vocoder']['chunk_frames'] > 0 or config['segmentation']['enabled']:
+        streams[token] = audio.ChunkStream()
+    task = tasks[token] = pool.submit(
+        _execute, request_body, token, time.monotonic(), speedup, table, inputs, client=entry['client'],
+        priority=entry['priority'], cost=_estimate_cost(dict(request_body, speedup=speedup))
+    )
+    speedups[token] = (speedup, speedup != int(request_body['speedup']))
+    admitted[token] = _estimate_memory(request_body)
+    return task
+
+
+def _estimate_memory(request: dict) -> int:
+    """
+    Estimate the peak size in bytes of the mel and waveform tensors of a task, at 4 bytes per mel bin and per
+    sample of every frame held at once. Segmented synthesis holds two windows per worker at a time and chunked
+    vocoding holds the waveform of a single chunk, but the stream of such a task buffers the whole song as
+    16-bit PCM until the task ends.
+    """
+    vocoder_config = config['vocoder']
+    frame_length = vocoder_config['hop_size'] / vocoder_config['sample_rate']
+    frames = int(sum(ph['duration'] for ph in request['phonemes']) / frame_length) + 1
+    mel_frames = wave_frames = frames
+    seg_config = config['segmentation']
+    if seg_config['enabled'] and seg_config['max_frames'] > 0:
+        window = seg_config['max_frames'] + 2 * seg_config['overlap']
+        mel_frames = wave_frames = min(frames, window * 2 * max(seg_config['workers'], 1))
+    elif vocoder_config['chunk_frames'] > 0:
+        wave_frames = min(frames, vocoder_config['chunk_frames'] + 2 * vocoder_config['chunk_overlap'])
+    memory = mel_frames * vocoder_config['num_mel_bins'] * 4 + wave_frames * vocoder_config['hop_size'] * 4
+    if vocoder_config['chunk_frames'] > 0 or seg_config['enabled']:
+        # See `audio.ChunkStream`, created by `_start_task` under the same condition
+        memory += frames * vocoder_config['hop_size'] * 2
+    return memory
+
+
+def _admission_refusal(memory: int):
+    """
+    Decide whether a new task estimated to need `memory` bytes may be queued. Returns None if so, or the
+    (reason, status code, message) to refuse it with: 413 if it is larger than admission.max_task_memory
+    (or else the whole budget), and 503 while the queued and running tasks use up admission.memory_budget.
+    Queued tasks count as well since each of them will run, so the budget also bounds the queue.
+    A task is always admitted when nothing else is in flight. Must be called with the mutex held.
+    """
+    admission_config = config['admission']
+    budget = admission_config['memory_budget'] * 1024 * 1024
+    limit = admission_config['max_task_memory'] * 1024 * 1024 or budget
+    if 0 < limit < memory:
+        return 'too_large', 413, \
+            f'Task needs about {memory / 1024 / 1024:.0f} MB, more than the limit of {limit / 1024 / 1024:.0f} MB.'
+    used = sum(admitted.values())
+    if budget > 0 and used > 0 and used + memory > budget:
+        return 'over_budget', 503, 'Server is busy, please retry later.'
+    return None
 
 
 def query(request: BaseHTTPRequestHandler):
+    """
+    Long polling is supported by passing "wait" (in seconds): the response is then held back until the
+    task reaches a final state or its status changes, either from the "status" given in the request
+    or, if omitted, from the status at the time the request arrived (including diffusion progress).
+    With "timings", the seconds spent so far in each stage of the task are returned as well.
+    Example:
+        {
+          "token": "01fe134ff10543c03aa858a7d8a638b2",
+          "wait": 30,
+          "status": "QUEUED",
+          "timings": true
+        }
+    """
     request_body = json.loads(request.rfile.read(int(request.headers['Content-Length'])))
     token = request_body['token']
-    cache_file = os.path.join(cache, f'{token}.wav')
-    if os.path.exists(cache_file):
-        res = {
+    if not utils.is_token(token):
+        _send_json(request, {'message': 'Invalid token.'}, code=400)
+        return
+    deadline = time.monotonic() + min(float(request_body.get('wait', 0)), config['server']['max_wait'])
+    with mutex:
+        version = status_version
+    res = initial = _task_status(token)
+    while res is not None and res['status'] not in FINAL_STATUSES:
+        if 'status' in request_body:
+            if res['status'] != request_body['status']:
+                break
+        elif _status_key(res) != _status_key(initial):
+            break
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        # Tasks of other nodes do not notify this one and are polled instead.
+        version = _wait_status(version, remaining if backend is None else min(remaining, BACKEND_POLL_INTERVAL))
+        res = _task_status(token)
+    if res is None:
+        request.send_error(404)
+        return
+    if request_body.get('timings') and task_timings is not None:
+        timings = task_timings.get(token)
+        if timings is not None:
+            res['timings'] = dict(timings)
+    _send_json(request, res)
+
+
+def events(request: BaseHTTPRequestHandler):
+    """
+    Server-sent events stream pushing the status of a task (same format as /query)
+    every time it changes, until the task reaches a final state.
+    """
+    params = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(request.path).query))
+    token = params['token']
+    if not utils.is_token(token):
+        _send_json(request, {'message': 'Invalid token.'}, code=400)
+        return
+    with mutex:
+        version = status_version
+    res = _task_status(token)
+    if res is None:
+        request.send_error(404)
+        return
+    request.send_response(200)
+    request.send_header('Content-Type', 'text/event-stream')
+    request.send_header('Cache-Control', 'no-cache')
+    request.send_header('Connection', 'close')
+    request.end_headers()
+    request.close_connection = True
+    last = None
+    try:
+        while True:
+            if res is None:
+                # The task has been removed from the queue by /cancel.
+                res = {'status': 'CANCELLED'}
+            if _status_key(res) != _status_key(last):
+                request.wfile.write(f'data: {json.dumps(res)}\n\n'.encode('utf8'))
+                if res['status'] in FINAL_STATUSES:
+                    return
+                last = res
+            else:
+                request.wfile.write(b': keep-alive\n\n')
+            deadline = time.monotonic() + (EVENTS_KEEPALIVE_INTERVAL if backend is None else BACKEND_POLL_INTERVAL)
+            while True:
+                version = _wait_status(version, max(deadline - time.monotonic(), 0))
+                res = _task_status(token)
+                if _status_key(res) != _status_key(last) or time.monotonic() >= deadline:
+                    break
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+
+
+def _wait_status(version: int, timeout: float) -> int:
+    """
+    Wait until a status changes after `version`, a value of `status_version`, or until `timeout` runs out.
+    Returns the current version. Statuses are built outside the mutex, so waiters compare versions instead.
+    """
+    with status_changed:
+        status_changed.wait_for(lambda: status_version != version, timeout=timeout)
+        return status_version
+
+
+def _status_changed():
+    """
+    Wake up the waiters of /query and /events. Must be called with the mutex held.
+    """
+    global status_version
+    status_version += 1
+    status_changed.notify_all()
+
+
+def _task_status(token: str):
+    """
+    Build the status response of a task, or return None if the token is unknown. Tasks and results of other
+    nodes are looked up in the shared backend outside the mutex, after which the local state is checked again
+    in case the task finished in the meantime.
+    """
+    with mutex:
+        res = _local_status(token)
+        if res is not None or backend is None:
+            return res if res is not None else _draft_or_failure_status(token, False)
+    if backend.has_result(token):
+        return {
             'status': 'HIT_CACHE'
         }
-        request.send_response(200)
-        request.send_header('Content-Type', 'application/json')
-        request.end_headers()
-        request.wfile.write(json.dumps(res).encode('utf8'))
-    else:
-        mutex.acquire()
-        if token in tasks:
-            task = tasks[token]
-            res = {}
-            if task.cancelled():
-                res['status'] = 'CANCELLED'
-            elif task.done():
-                if token in failures:
-                    res['status'] = 'FAILED'
-                    res['message'] = failures[token]
-                else:
-                    res['status'] = 'FINISHED'
-            elif task.running():
-                res['status'] = 'RUNNING'
+    shared_draft = backend.has_result(_draft_key(token))
+    with mutex:
+        res = _local_status(token) or _draft_or_failure_status(token, shared_draft)
+    if res is not None:
+        return res
+    shared = backend.status(token)
+    if shared is None:
+        return None
+    res = {
+        'status': shared['status'],
+        'node': shared['node']
+    }
+    if shared['message'] is not None:
+        res['message'] = shared['message']
+    return res
+
+
+def _local_status(token: str):
+    """
+    Build the status response of a task cached or queued on this node, or return None.
+    Must be called with the mutex held.
+    """
+    if audio_cache.contains(token):
+        return {
+            'status': 'HIT_CACHE'
+        }
+    if token in tasks:
+        task = tasks[token]
+        res = {}
+        if task.cancelled():
+            res['status'] = 'CANCELLED'
+        elif task.done():
+            message = _recent_failure(token)
+            if message is not None:
+                res['status'] = 'FAILED'
+                res['message'] = message
             else:
-                res['status'] = 'QUEUED'
-            request.send_response(200)
-            request.send_header('Content-Type', 'application/json')
-            request.end_headers()
-            request.wfile.write(json.dumps(res).encode('utf8'))
-        elif token in failures:
-            res = {
-                'status': 'FAILED',
-                'message': failures[token]
-            }
-            request.send_response(200)
-            request.send_header('Content-Type', 'application/json')
-            request.end_headers()
-            request.wfile.write(json.dumps(res).encode('utf8'))
+                res['status'] = 'FINISHED'
+        elif task.running():
+            res['status'] = 'RUNNING'
+            # Progress is kept per effective speedup, so that a draft and its follow-up are never mixed up.
+            task_progress = progress.get((token, speedups[token][0]))
+            if task_progress is not None:
+                res['progress'] = {
+                    'steps': task_progress[0],
+                    'total': task_progress[1]
+                }
         else:
-            request.send_error(404)
-        mutex.release()
+            res['status'] = 'QUEUED'
+            queue_info = pool.queue_info(task)
+            if queue_info is not None:
+                res['position'], res['eta'] = queue_info
+        res['speedup'], draft = speedups[token]
+        if draft:
+            res['draft'] = True
+        return res
+    return None
 
 
-def cancel(request: BaseHTTPRequestHandler):
-    request_body = json.loads(request.rfile.read(int(request.headers['Content-Length'])))
-    token = request_body['token']
-    code = request_body['code']
-    mutex.acquire()
-    if os.path.exists(os.path.join(cache, f'{token}.wav')):
+def _draft_or_failure_status(token: str, shared_draft: bool):
+    """
+    Build the status response of a task with only a draft result, local or shared (`shared_draft`), or a recent
+    failure, or return None. Must be called with the mutex held.
+    """
+    if audio_cache.contains(_draft_key(token)) or shared_draft:
         res = {
-            'succeeded': False,
-            'message': 'Task result already in cache.'
+            'status': 'HIT_CACHE',
+            'draft': True
         }
-    elif token not in tasks or code not in piles[token]:
-        res = {
-            'succeeded': False,
-            'message': 'Invalid token or code.'
+        if token in drafts:
+            res['speedup'] = drafts[token]
+        return res
+    message = _recent_failure(token)
+    if message is not None:
+        return {
+            'status': 'FAILED',
+            'message': message
         }
-    else:
-        piles[token].remove(code)
-        if len(piles[token]) == 0:
-            tasks[token].cancel()
-            tasks.pop(token)
-            piles.pop(token)
-        res = {
-            'succeeded': True
+    return None
+
+
+def _recent_failure(token: str):
+    """
+    Return the message of the failure of a task if it is at most server.failure_ttl seconds old, or None.
+    Expired failures are dropped here, as new failures only prune the ones before them. Must be called
+    with the mutex held.
+    """
+    if token not in failures:
+        return None
+    message, failed_at = failures[token]
+    ttl = config['server']['failure_ttl']
+    if ttl > 0 and failed_at < time.time() - ttl:
+        failures.pop(token)
+        return None
+    return message
+
+
+def _pull_shared(key: str) -> bool:
+    """
+    Copy a result published by another node into the local audio cache. Returns False if there is none.
+    """
+    if backend is None or not backend.has_result(key):
+        return False
+    temp_file = audio_cache.temp_path(key)
+    if not backend.fetch(key, temp_file):
+        return False
+    audio_cache.commit(key, temp_file)
+    return True
+
+
+def _maintain_backend():
+    """
+    Every third of the lease: renew the leases of the tasks of this node, take over the tasks of nodes
+    that stopped renewing theirs, and remove old shared results and failures.
+    """
+    while True:
+        time.sleep(backend.lease / 3)
+        try:
+            with mutex:
+                tokens = list(tasks)
+            backend.renew(tokens)
+            for token, entry in backend.expired():
+                if _restart_task(token, entry):
+                    logging.info(f'Task \'{token}\' taken over')
+            backend.sweep(config['backend']['max_age'])
+        except Exception as e:
+            logging.error(f'Maintenance of the shared backend failed: {e}')
+
+
+def _restart_task(token: str, entry: dict) -> bool:
+    """
+    Queue again a task submitted earlier, either to this node before a restart (from the journal) or to a
+    node whose lease expired (from the shared backend). Returns False if the task is already queued, cached
+    or owned by another node. Nobody holds a code to cancel a restarted task.
+    """
+    binding = model_bindings.get(entry['request'].get('model'))
+    with mutex:
+        if token in tasks or audio_cache.contains(token):
+            return False
+    # Claims go to the shared volume and are made outside the mutex.
+    if backend is not None and backend.claim(token, entry) != backend.node:
+        return False
+    if binding is None:
+        _fail_task(token, f'Unknown model \'{entry["request"].get("model")}\'.')
+        return False
+    if entry['priority'] not in pool.weights:
+        entry = dict(entry, priority=None)
+    with mutex:
+        if token in tasks or audio_cache.contains(token):
+            return False
+        future = _start_task(token, entry, binding[0])
+        piles[token] = []
+    future.add_done_callback(_notify_status)
+    return True
+
+
+def _fail_task(token: str, message: str):
+    """
+    Record the failure of a task. Failures are reported by /query for server.failure_ttl seconds.
+    """
+    with mutex:
+        failures.pop(token, None)
+        failures[token] = (message, time.time())
+        ttl = config['server']['failure_ttl']
+        # Failures are kept in the order they happened, so the expired ones come first.
+        while ttl > 0 and next(iter(failures.values()))[1] < time.time() - ttl:
+            failures.pop(next(iter(failures)))
+    if backend is not None:
+        backend.update(token, 'FAILED', message)
+    if task_journal is not None:
+        task_journal.failed(token, message)
+
+
+def _compact_journal():
+    while True:
+        time.sleep(config['journal']['compact_interval'])
+        try:
+            removed = task_journal.compact()
+            logging.debug(f'Compacted the task journal, removing {removed} tasks')
+        except Exception as e:
+            logging.error(f'Compaction of the task journal failed: {e}')
+
+
+def _draft_key(token: str) -> str:
+    return f'{token}-draft'
+
+
+def _status_key(res: dict):
+    # Queue position and estimated start time drift all the time and do not count as status changes.
+    return None if res is None else (res['status'], res.get('progress'), res.get('speedup'), res.get('draft'))
+
+
+def _estimate_cost(request: dict) -> float:
+    """
+    Estimate the cost of a task as its frame count times its number of diffusion steps.
+    """
+    frame_length = config['vocoder']['hop_size'] / config['vocoder']['sample_rate']
+    frames = sum(ph['duration'] for ph in request['phonemes']) / frame_length
+    return frames * synthesis.diffusion_steps(config, int(request['speedup']))
+
+
+def _caches() -> dict:
+    caches = {'audio': audio_cache, 'segment': segment_cache, 'mel': mel_cache, 'rhythm': rhythm_memo}
+    return {name: c.stats() for name, c in caches.items() if c is not None}
+
+
+def _register_metrics():
+    metrics.registry.register(metrics.Gauge(
+        'diffsinger_queue_depth', 'Tasks waiting in the scheduler queue.',
+        fn=lambda: {(): pool.pending()}
+    ))
+    metrics.registry.register(metrics.Counter(
+        'diffsinger_cache_hits_total', 'Cache lookups that found an entry.', ('cache',),
+        fn=lambda: {(name,): res['hits'] for name, res in _caches().items()}
+    ))
+    metrics.registry.register(metrics.Counter(
+        'diffsinger_cache_misses_total', 'Cache lookups that found nothing.', ('cache',),
+        fn=lambda: {(name,): res['misses'] for name, res in _caches().items()}
+    ))
+    metrics.registry.register(metrics.Gauge(
+        'diffsinger_admitted_memory_bytes', 'Estimated tensor memory of queued and running tasks.',
+        fn=lambda: {(): sum(admitted.values())}
+    ))
+    metrics.registry.register(metrics.Gauge(
+        'diffsinger_cache_hit_ratio', 'Share of cache lookups that found an entry.', ('cache',),
+        fn=lambda: {
+            (name,): res['hits'] / (res['hits'] + res['misses'])
+            for name, res in _caches().items() if res['hits'] + res['misses'] > 0
         }
-    mutex.release()
-    request.send_response(200)
-    request.send_header('Content-Type', 'application/json')
-    request.end_headers()
-    request.wfile.write(json.dumps(res).encode('utf8'))
+    ))
+
+
+def _notify_status(*_):
+    with mutex:
+        _status_changed()
+
+
+def cancel(request: BaseHTTPRequestHandler):
+    request_body = json.loads(request.rfile.read(int(request.headers['Content-Length'])))
+    token = request_body['token']
+    if not utils.is_token(token):
+        _send_json(request, {'message': 'Invalid token.'}, code=400)
+        return
+    code = request_body['code']
+    released = False
+    with mutex:
+        if audio_cache.contains(token):
+            res = {
+                'succeeded': False,
+                'message': 'Task result already in cache.'
+            }
+        elif token in followups and code in followups[token][2]:
+            followups[token][2].remove(code)
+            if len(followups[token][2]) == 0:
+                followups.pop(token)
+            res = {
+                'succeeded': True
+            }
+        elif token not in tasks or code not in piles[token]:
+            res = {
+                'succeeded': False,
+                'message': 'Invalid token or code.'
+            }
+        else:
+            piles[token].remove(code)
+            # A running task cannot be cancelled and is left to finish.
+            if len(piles[token]) == 0 and tasks[token].cancel():
+                tasks.pop(token)
+                piles.pop(token)
+                speedups.pop(token)
+                admitted.pop(token)
+                if token in streams:
+                    streams.pop(token).close('Task cancelled.')
+                if task_journal is not None:
+                    task_journal.cancelled(token)
+                metrics.TASKS.inc(status='CANCELLED')
+                released = True
+            res = {
+                'succeeded': True
+            }
+    if released and backend is not None:
+        backend.release(token)
+    _send_json(request, res)
 
 
 def download(request: BaseHTTPRequestHandler):
+    """
+    Download a cached result. The output format is chosen by the `format` query parameter
+    (see audio.FORMATS) or the Accept header; the stored format is served without transcoding.
+    Files are sent with sendfile, support single byte ranges and revalidation by ETag.
+    """
     params = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(request.path).query))
     token = params['token']
-    cache_file = os.path.join(cache, f'{token}.wav')
-    if os.path.exists(cache_file):
-        request.send_response(200)
-        request.send_header('Content-Type', 'audio/wav')
+    if not utils.is_token(token):
+        _send_json(request, {'message': 'Invalid token.'}, code=400)
+        return
+    audio_format = audio.negotiate_format(audio_cache.format, params.get('format'), request.headers.get('Accept'))
+    if audio_format is None:
+        request.send_error(406)
+        return
+    f, key = _open_cached(token)
+    if f is None:
+        request.send_error(404)
+        return
+    etag = f'"{key}"' if audio_format == audio_cache.format else f'"{key}-{audio_format}"'
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None and (
+            if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]):
+        f.close()
+        request.send_response(304)
+        request.send_header('ETag', etag)
         request.end_headers()
-        with open(cache_file, 'rb') as f:
-            request.wfile.write(f.read())
+        return
+    if audio_format != audio_cache.format:
+        with f:
+            f = _open_transcoded(f, key, audio_format)
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        byte_range = (0, size - 1)
+        if request.headers.get('Range') is not None:
+            byte_range = _parse_range(request.headers['Range'], size)
+            if byte_range is None:
+                request.send_response(416)
+                request.send_header('Content-Range', f'bytes */{size}')
+                request.send_header('Content-Length', '0')
+                request.end_headers()
+                return
+            request.send_response(206)
+            request.send_header('Content-Range', f'bytes {byte_range[0]}-{byte_range[1]}/{size}')
+        else:
+            request.send_response(200)
+        request.send_header('Content-Type', audio.FORMATS[audio_format]['mime'])
+        request.send_header('Content-Length', str(byte_range[1] - byte_range[0] + 1))
+        request.send_header('ETag', etag)
+        request.send_header('Accept-Ranges', 'bytes')
+        request.send_header('Vary', 'Accept')
+        request.end_headers()
+        if size > 0:
+            request.connection.sendfile(f, byte_range[0], byte_range[1] - byte_range[0] + 1)
+
+
+def _open_transcoded(f, key: str, audio_format: str):
+    """
+    Open the result `f` of `key` transcoded into `audio_format`. Transcoded files are kept in the audio cache
+    under `{key}-{format}`, so that the range requests of a download do not transcode the whole song each time.
+    """
+    transcoded_key = f'{key}-{audio_format}'
+    cache_file = audio_cache.lookup(transcoded_key, count=False)
+    if cache_file is not None:
+        try:
+            return open(cache_file, 'rb')
+        except FileNotFoundError:
+            # Evicted in the meantime
+            pass
+    temp_file = audio_cache.temp_path(transcoded_key)
+    transcoded = audio.transcode(f, audio_format, temp_file)
+    # The open file stays readable even if the entry is evicted right after being committed.
+    audio_cache.commit(transcoded_key, temp_file)
+    return transcoded
+
+
+def _parse_range(header: str, size: int):
+    """
+    Parse a single byte range of a Range header into inclusive (start, end) offsets.
+    Returns None if the range cannot be satisfied. Multiple ranges are answered with the whole file.
+    """
+    unit, _, ranges = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in ranges:
+        return 0, size - 1
+    start, _, end = ranges.strip().partition('-')
+    try:
+        if start == '':
+            length = int(end)
+            if length <= 0:
+                return None
+            return max(size - length, 0), size - 1
+        start = int(start)
+        end = min(int(end), size - 1) if end != '' else size - 1
+    except ValueError:
+        return 0, size - 1
+    if start >= size or start > end:
+        return None
+    return start, end
+
+
+def stream(request: BaseHTTPRequestHandler):
+    """
+    Stream the audio of a task while it is still being synthesized, using chunked transfer encoding.
+    Requires chunked vocoder mode (vocoder.chunk_frames > 0) or segmentation; finished results are
+    streamed from the cache.
+    """
+    params = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(request.path).query))
+    token = params['token']
+    if not utils.is_token(token):
+        _send_json(request, {'message': 'Invalid token.'}, code=400)
+        return
+    with mutex:
+        chunk_stream = streams.get(token)
+    f = None
+    if chunk_stream is None:
+        f, _ = _open_cached(token)
+        if f is None:
+            request.send_error(404)
+            return
+    # HTTP/1.0 clients do not understand chunked encoding and read until the connection closes.
+    chunked = request.request_version != 'HTTP/1.0'
+    request.send_response(200)
+    request.send_header('Content-Type', 'audio/wav' if f is None else audio.FORMATS[audio_cache.format]['mime'])
+    if chunked:
+        request.send_header('Transfer-Encoding', 'chunked')
+    else:
+        request.send_header('Connection', 'close')
+    request.end_headers()
+    if chunk_stream is not None:
+        _write_chunk(request, audio.wav_header(config['vocoder']['sample_rate']), chunked)
+        try:
+            for data in chunk_stream.read():
+                _write_chunk(request, data, chunked)
+        except RuntimeError as e:
+            # Leave the response unterminated so that the client notices the failure.
+            logging.error(f'Stream of task \'{token}\' aborted: {e}')
+            request.close_connection = True
+            return
+    else:
+        with f:
+            while True:
+                data = f.read(STREAM_BLOCK_SIZE)
+                if not data:
+                    break
+                _write_chunk(request, data, chunked)
+    if chunked:
+        request.wfile.write(b'0\r\n\r\n')
+
+
+def _send_json(request: BaseHTTPRequestHandler, res: dict, code: int = 200, headers: dict = None):
+    body = json.dumps(res).encode('utf8')
+    request.send_response(code)
+    request.send_header('Content-Type', 'application/json')
+    request.send_header('Content-Length', str(len(body)))
+    for name, value in (headers or {}).items():
+        request.send_header(name, value)
+    request.end_headers()
+    request.wfile.write(body)
+
+
+def _open_cached(token: str):
+    """
+    Open the cached result of a task, falling back to its draft, and return the file and its cache key,
+    or (None, None) if neither is cached. Results published by other nodes are copied into the local cache first.
+    """
+    for key in [token, _draft_key(token)]:
+        # Only the lookup of the result itself counts; the draft is a fallback.
+        cache_file = audio_cache.lookup(key, count=key == token)
+        if cache_file is None:
+            if not _pull_shared(key):
+                continue
+            cache_file = audio_cache.path(key)
+        try:
+            return open(cache_file, 'rb'), key
+        except FileNotFoundError:
+            # Evicted in the meantime
+            continue
+    return None, None
+
+
+def _write_chunk(request: BaseHTTPRequestHandler, data: bytes, chunked: bool):
+    if chunked:
+        request.wfile.write(f'{len(data):X}\r\n'.encode('ascii') + data + b'\r\n')
     else:
-        request.send_response(404)
+        request.wfile.write(data)
+
 
+def _execute(request: dict, token: str, submitted: float, speedup: int, table: utils.PhonemeTable,
+             inputs: tuple = None):
+    with metrics.collect() as timings:
+        if task_timings is not None:
+            task_timings.put(token, timings)
+        metrics.record('queue', time.monotonic() - submitted)
+        try:
+            if speedup != int(request['speedup']):
+                _run_task(dict(request, speedup=speedup), token, _draft_key(token), table, inputs)
+            else:
+                _run_task(request, token, token, table, inputs)
+        finally:
+            if quality is not None:
+                quality.observe(time.monotonic() - submitted)
 
-def _execute(request: dict, cache_file: str, token: str):
-    logging.info(f'Task \'{token}\' begins')
+
+def _run_task(request: dict, token: str, key: str, table: utils.PhonemeTable, inputs: tuple = None):
+    """
+    Synthesize a request and store the result in the audio cache under `key`, which is
+    either the token of the task or, for drafts rendered with a raised speedup, its draft key.
+    The request is preprocessed here only if `inputs` were not computed at submission.
+    """
+    if key == token:
+        logging.info(f'Task \'{token}\' begins')
+    else:
+        logging.info(f'Task \'{token}\' begins as a draft with speedup {request["speedup"]}')
+    if backend is not None:
+        backend.update(token, 'RUNNING')
+    if task_journal is not None:
+        task_journal.started(token)
+    acoustic = os.path.join(acoustic_root, f'{request["model"]}.onnx')
+    chunk_stream = streams.get(token)
+    _notify_status()
+
+    def report_progress(done: int, total: int):
+        with mutex:
+            progress[(token, int(request['speedup']))] = (done, total)
+            _status_changed()
+
+    temp_file = audio_cache.temp_path(key)
+    audio_format = audio.FORMATS[audio_cache.format]
     try:
-        wav = synthesis.run_synthesis(
-            request, phoneme_list,
-            os.path.join(ACOUSTIC_ROOT, f'{request["model"]}.onnx'),
-            config
-        )
-        os.makedirs(cache, exist_ok=True)
-        soundfile.write(cache_file, wav, config['vocoder']['sample_rate'])
+        if inputs is None:
+            # Tasks replayed from the journal or taken over from another node
+            inputs = synthesis.preprocess_request(request, table.index, config)
+        if process_pool is not None:
+            pieces = [worker.run(process_pool, inputs, request, acoustic)]
+        elif config['segmentation']['enabled']:
+            pieces = synthesis.segmented_synthesis(
+                request, table.index, acoustic, config, segment_cache, batchers=batchers, mel_cache=mel_cache,
+                progress=report_progress, executor=segment_pool, inputs=inputs
+            )
+        elif chunk_stream is not None:
+            pieces = synthesis.stream_synthesis(
+                request, table.index, acoustic, config,
+                batchers=batchers, mel_cache=mel_cache, progress=report_progress, inputs=inputs
+            )
+        else:
+            pieces = [synthesis.run_synthesis(
+                request, table.index, acoustic, config,
+                batchers=batchers, mel_cache=mel_cache, progress=report_progress, inputs=inputs
+            )]
+        with soundfile.SoundFile(temp_file, 'w', samplerate=config['vocoder']['sample_rate'], channels=1,
+                                 format=audio_format['format'], subtype=audio_format['subtype']) as f:
+            for piece in pieces:
+                with metrics.stage('write'):
+                    f.write(piece)
+                    if chunk_stream is not None:
+                        chunk_stream.put(audio.float_to_pcm16(piece))
+        if backend is not None:
+            backend.store(key, temp_file)
+            if key == token:
+                backend.discard(_draft_key(token))
+            backend.update(token, 'FINISHED')
+        audio_cache.commit(key, temp_file)
+        with mutex:
+            if key == token:
+                # The full-quality result replaces any draft.
+                for draft_key in [_draft_key(token)] + [f'{_draft_key(token)}-{name}' for name in audio.FORMATS]:
+                    audio_cache.discard(draft_key)
+                drafts.pop(token, None)
+            else:
+                for t in [t for t in drafts if not audio_cache.contains(_draft_key(t))]:
+                    drafts.pop(t)
+                drafts[token] = request['speedup']
+        if task_journal is not None:
+            task_journal.finished(token)
+        metrics.TASKS.inc(status='FINISHED')
         logging.info(f'Task \'{token}\' finished')
     except Exception as e:
-        failures[token] = str(e)
+        metrics.TASKS.inc(status='FAILED')
+        _fail_task(token, str(e))
         logging.error(f'Task \'{token}\' failed')
         logging.error(str(e))
+        if chunk_stream is not None:
+            chunk_stream.close(str(e))
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
         raise e
     finally:
-        mutex.acquire()
-        tasks.pop(token)
-        piles.pop(token)
-        mutex.release()
+        followup = None
+        with mutex:
+            tasks.pop(token)
+            piles.pop(token)
+            speedups.pop(token)
+            admitted.pop(token)
+            progress.pop((token, int(request['speedup'])), None)
+            if token in streams:
+                streams.pop(token).close()
+            if token in followups:
+                # Full-quality requests that arrived while this draft was in flight. They share the token and
+                # hence the inputs of the draft.
+                entry, followup_table, codes = followups.pop(token)
+                followup = _start_task(token, entry, followup_table, inputs)
+                piles[token] = codes
+            _status_changed()
+        if followup is not None:
+            followup.add_done_callback(_notify_status)
+            if backend is not None:
+                backend.claim(token, entry)
 
 
 config = {}
-dictionary = {}
-dict_pad = -1
-phoneme_list = []
-vowels = set()
+model_bindings: utils.ModelBindings
+acoustic_root = ''
 vocoder_path = ''
 cache = ''
-pool: ThreadPoolExecutor
+audio_cache: caching.AudioCache
+segment_cache = None
+segment_pool = None
+pool: scheduler.FairScheduler
+process_pool = None
+batchers = None
+mel_cache = None
+rhythm_memo = None
+task_timings = None
+quality = None
+backend = None
+task_journal = None
 tasks = {}
 piles = {}
+speedups = {}
+followups = {}
+admitted = {}
+drafts = {}
 failures = {}
+streams = {}
+progress = {}
+status_version = 0
 
 apis = {
     '/version': (version, ['GET']),
     '/models': (models, ['GET']),
+    '/stats': (stats, ['GET']),
+    '/metrics': (export_metrics, ['GET']),
     '/rhythm': (rhythm, ['POST']),
+    '/rhythm/batch': (rhythm_batch, ['POST']),
     '/submit': (submit, ['POST']),
     '/query': (query, ['POST']),
+    '/events': (events, ['GET']),
     '/cancel': (cancel, ['POST']),
-    '/download': (download, ['GET'])
+    '/download': (download, ['GET']),
+    '/stream': (stream, ['GET'])
 }
-mutex = threading.Lock()
+mutex = threading.RLock()
+status_changed = threading.Condition(mutex)
 
 
 class Request(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Idle persistent connections are closed after this many seconds.
+    timeout = 60
+
     def do_GET(self):
         url_split = urllib.parse.urlsplit(self.path)
         url_path = url_split.path.rstrip('/')
@@ -309,43 +1199,199 @@ class Request(BaseHTTPRequestHandler):
             self.send_error(404)
         elif 'POST' not in apis[url_path][1]:
             self.send_error(405)
-        else:
+        elif self._check_body_size():
             apis[url_path][0](self)
 
+    def handle_expect_100(self):
+        # Clients sending "Expect: 100-continue" learn that their body is too large before sending it.
+        if self.command == 'POST' and not self._check_body_size():
+            return False
+        return super().handle_expect_100()
+
+    def _check_body_size(self) -> bool:
+        """
+        Refuse bodies without a length or larger than admission.max_body_size before they are read.
+        """
+        try:
+            length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            self.send_error(411)
+            return False
+        max_size = config['admission']['max_body_size'] * 1024 * 1024
+        if 0 < max_size < length:
+            # The body is left unread, so the connection cannot be reused.
+            self.close_connection = True
+            metrics.REJECTIONS.inc(reason='body_size')
+            _send_json(self, {'message': f'Request body is larger than {max_size // 1024 // 1024} MB.'}, code=413)
+            return False
+        return True
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Start DiffSinger inference server')
-    parser.add_argument('--config', type=str, required=False, default='default')
+    parser.add_argument('--config', type=str, required=False, default='default',
+                        help='name of a config in the configs directory or path to a YAML file')
     args = parser.parse_args()
 
-    cfg_path = os.path.join(CONFIG_ROOT, f'{args.config}.yaml')
+    if args.config.endswith(('.yaml', '.yml')):
+        cfg_path = args.config
+    else:
+        cfg_path = os.path.join(CONFIG_ROOT, f'{args.config}.yaml')
     config.update(utils.load_configs(cfg_path))
     logging.info(f'Using config from \'{cfg_path}\'')
 
     dict_path = config['dictionary']['filename']
     if not os.path.isabs(dict_path):
         dict_path = os.path.join(SERVER_ROOT, dict_path)
-    dict_pad = config['dictionary']['reserved_tokens']
-    dictionary.update(utils.load_dictionary(dict_path))
-    vowels.update(utils.dictionary_to_vowels(dictionary))
-    logging.info(f'Loaded dictionary from \'{dict_path}\'')
-
-    phoneme_list.extend(utils.dictionary_to_phonemes(dictionary, dict_pad))
+    config['dictionary']['filename'] = dict_path
+    rhythmizer_path = config['rhythmizer']['filename']
+    if not os.path.isabs(rhythmizer_path):
+        rhythmizer_path = os.path.join(SERVER_ROOT, rhythmizer_path)
+    config['rhythmizer']['filename'] = rhythmizer_path
+    acoustic_root = config['acoustic']['directory']
+    if not os.path.isabs(acoustic_root):
+        acoustic_root = os.path.join(SERVER_ROOT, acoustic_root)
+    model_bindings = utils.ModelBindings(config, acoustic_root, SERVER_ROOT)
     vocoder_path = config['vocoder']['filename']
     if not os.path.isabs(vocoder_path):
         vocoder_path = os.path.join(SERVER_ROOT, vocoder_path)
     assert os.path.exists(vocoder_path), 'Vocoder model not found. Please check your configuration.'
+    config['vocoder']['filename'] = vocoder_path
     logging.info(f'Found vocoder at \'{vocoder_path}\'')
 
+    sessions_config = config['sessions']
+    profile_dir = None
+    if sessions_config['profiling']['enabled']:
+        profile_dir = sessions_config['profiling']['directory']
+        if not os.path.isabs(profile_dir):
+            profile_dir = os.path.join(SERVER_ROOT, profile_dir)
+        sessions_config['profiling']['directory'] = profile_dir
+        logging.info(f'Profiles of inference sessions will be saved in \'{profile_dir}\'')
+    utils.session_pool.configure(
+        max_count=sessions_config['max_count'],
+        max_memory=sessions_config['max_memory'] * 1024 * 1024,
+        intra_op_num_threads=sessions_config['intra_op_threads'],
+        inter_op_num_threads=sessions_config['inter_op_threads'],
+        profile_dir=profile_dir
+    )
+    preload = sessions_config['preload']
+    if preload['vocoder']:
+        utils.session_pool.get(vocoder_path, config['providers'], force_on_cpu=config['vocoder']['force_on_cpu'])
+        logging.info('Preloaded vocoder')
+    if preload['rhythmizer'] and os.path.exists(rhythmizer_path):
+        utils.session_pool.get(rhythmizer_path, config['providers'])
+        logging.info('Preloaded rhythmizer')
+    for model in preload['acoustic']:
+        utils.session_pool.get(os.path.join(acoustic_root, f'{model}.onnx'), config['providers'])
+        logging.info(f'Preloaded acoustic model \'{model}\'')
+
     cache = config['server']['cache_dir']
     if not os.path.isabs(cache):
         cache = os.path.join(SERVER_ROOT, cache)
     logging.info(f'Cache will be saved in \'{cache}\'')
+    cache_config = config['server']['cache']
+    audio_cache = caching.AudioCache(
+        cache, audio_format=cache_config['format'], max_bytes=cache_config['max_size'] * 1024 * 1024,
+        max_entries=cache_config['max_entries'], policy=cache_config['policy']
+    )
+    if config['segmentation']['enabled']:
+        segment_cache = caching.ArrayCache(
+            os.path.join(cache, 'segments'), max_bytes=config['segmentation']['cache_size'] * 1024 * 1024,
+            policy=cache_config['policy']
+        )
+        if config['segmentation']['workers'] > 1:
+            segment_pool = ThreadPoolExecutor(config['segmentation']['workers'], thread_name_prefix='segment')
+    if config['server']['mel_cache']['enabled']:
+        mel_cache = caching.MelCache(
+            os.path.join(cache, 'mel'), max_bytes=config['server']['mel_cache']['max_size'] * 1024 * 1024,
+            policy=cache_config['policy']
+        )
+
+    if config['rhythmizer']['memo_size'] > 0:
+        rhythm_memo = caching.MemoryCache(config['rhythmizer']['memo_size'])
+    if config['server']['timings'] > 0:
+        task_timings = caching.MemoryCache(config['server']['timings'])
+
+    scheduler_config = config['scheduler']
+    processes = config['server']['processes']
+    if processes > 0:
+        # Synthesis runs in worker processes, each with its own warm sessions.
+        # One thread per process keeps the task bookkeeping in this process.
+        worker_preload = []
+        if preload['vocoder']:
+            worker_preload.append((vocoder_path, config['vocoder']['force_on_cpu']))
+        for model in preload['acoustic']:
+            worker_preload.append((os.path.join(acoustic_root, f'{model}.onnx'), False))
+        process_pool = ProcessPoolExecutor(
+            max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+            initializer=worker.initialize, initargs=(config, worker_preload)
+        )
+        pool = scheduler.FairScheduler(processes, scheduler_config['weights'], scheduler_config['default_priority'])
+        if config['batching']['enabled'] or config['segmentation']['enabled'] or config['vocoder']['chunk_frames'] > 0:
+            logging.warning('Batching, segmentation and chunked vocoding are not used by worker processes.')
+        logging.info(f'Synthesis runs in {processes} worker processes')
+    else:
+        pool = scheduler.FairScheduler(
+            config['server']['max_threads'], scheduler_config['weights'], scheduler_config['default_priority']
+        )
+    if config['batching']['enabled'] and process_pool is None:
+        if config['server']['max_threads'] < 2:
+            logging.warning('Batching is enabled but max_threads is 1, so batches will never be filled.')
+        batchers = synthesis.create_batchers(config)
+        logging.info('Micro-batching enabled')
+
+    preview_config = config['preview']
+    if preview_config['adaptive']:
+        quality = scheduler.QualityPolicy(
+            pool, config['acoustic']['diffusion_steps'], preview_config['max_speedup'],
+            max_queue_depth=preview_config['max_queue_depth'], latency_slo=preview_config['latency_slo']
+        )
+        logging.info('Adaptive speedup of previews enabled')
+
+    backend_config = config['backend']
+    if backend_config['enabled']:
+        shared_dir = backend_config['directory']
+        if not os.path.isabs(shared_dir):
+            shared_dir = os.path.join(SERVER_ROOT, shared_dir)
+        backend = backends.create_backend(
+            backend_config, shared_dir, audio.FORMATS[audio_cache.format]['extension'],
+            backend_config['node'] or f'{socket.gethostname()}:{config["server"]["port"]}'
+        )
+        threading.Thread(target=_maintain_backend, name='backend', daemon=True).start()
+        logging.info(f'Sharing tasks and results with other nodes as \'{backend.node}\'')
+
+    journal_config = config['journal']
+    if journal_config['enabled']:
+        journal_path = journal_config['filename']
+        if not os.path.isabs(journal_path):
+            journal_path = os.path.join(SERVER_ROOT, journal_path)
+        task_journal = journal.TaskJournal(journal_path, failure_ttl=config['server']['failure_ttl'])
+        for token, message, failed_at in task_journal.failures():
+            failures[token] = (message, failed_at)
+        restored = len(failures)
+        restarted = 0
+        given_up = 0
+        max_attempts = journal_config['max_attempts']
+        for token, entry, attempts in task_journal.unfinished():
+            if 0 < max_attempts <= attempts and not audio_cache.contains(token):
+                # Most likely the task itself brings the server down, e.g. by running out of memory.
+                logging.warning(f'Task \'{token}\' was interrupted {attempts} times while running; giving up')
+                _fail_task(token, f'Task was interrupted {attempts} times while running.')
+                given_up += 1
+            elif _restart_task(token, entry):
+                restarted += 1
+            elif token not in failures:
+                # Cached in the meantime or taken over by another node
+                task_journal.cancelled(token)
+        logging.info(f'Replayed the task journal at \'{journal_path}\': {restarted} tasks queued again, '
+                     f'{given_up} given up, {restored} failures restored, '
+                     f'{task_journal.compact()} finished tasks compacted')
+        threading.Thread(target=_compact_journal, name='journal', daemon=True).start()
 
-    pool = ThreadPoolExecutor(max_workers=config['server']['max_threads'])
+    _register_metrics()
 
     host = ('127.0.0.1', config['server']['port'])
-    with HTTPServer(host, Request) as server:
+    with ThreadingHTTPServer(host, Request) as server:
         logging.info('Server starting at %s:%s' % host)
         try:
             server.serve_forever()
@@ -353,3 +1399,12 @@ if __name__ == '__main__':
             pass
         except InterruptedError:
             pass
+        finally:
+            if process_pool is not None:
+                process_pool.shutdown(cancel_futures=True)
+            # Dumps the profiles of the sessions if profiling is enabled
+            utils.session_pool.clear()
+            if backend is not None:
+                backend.close()
+            if task_journal is not None:
+                task_journal.close()
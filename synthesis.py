@@ -1,99 +1,196 @@
+import collections
+import itertools
+import os
+
 import numpy as np
 
+import batching
+import metrics
 import utils
 
+REST_PHONEMES = {'AP', 'SP'}
+
+
+def phonemes_to_tokens(name2token: dict, phonemes: list) -> np.ndarray:
+    try:
+        return np.array([name2token[ph] for ph in phonemes], dtype=np.int64)
+    except KeyError:
+        unknown = sorted({str(ph) for ph in phonemes if ph not in name2token})
+        raise utils.PhonemeError(f'Unknown phonemes: {", ".join(unknown)}.') from None
 
-def rhythm_preprocess(name2token: list,
+
+def rhythm_preprocess(name2token: dict,
                       words: list,
                       midi: list,
                       midi_dur: list,
                       is_slur: list):
-    tokens = []
-    midi_seq = []
-    midi_dur_seq = []
-    is_slur_seq = []
-    last_phoneme = 'SP'
-    for i in range(len(words)):
-        if not is_slur[i]:
-            for ph in words[i]:
-                tokens.append(name2token.index(ph))
-                midi_seq.append(midi[i])
-                midi_dur_seq.append(midi_dur[i])
-                is_slur_seq.append(False)
-            last_phoneme = words[i][-1]
-        else:
-            tokens.append(name2token.index(last_phoneme))
-            midi_seq.append(midi[i])
-            midi_dur_seq.append(midi_dur[i])
-            is_slur_seq.append(True)
-    tokens = np.array(tokens, dtype=np.int64)
-    midi_seq = np.array(midi_seq, dtype=np.int64)
-    midi_dur_seq = np.array(midi_dur_seq, dtype=np.float32)
-    is_slur_seq = np.array(is_slur_seq, dtype=np.bool_)
-    return tokens[None], midi_seq[None], midi_dur_seq[None], is_slur_seq[None]
+    is_slur = np.array(is_slur, dtype=np.bool_)
+    # A slur repeats the last phoneme of the closest word before it, or SP if there is none.
+    owners = np.maximum.accumulate(np.where(is_slur, -1, np.arange(len(words))))
+    note_phonemes = [
+        ([words[owner][-1]] if owner >= 0 else ['SP']) if slur else words[i]
+        for i, (slur, owner) in enumerate(zip(is_slur.tolist(), owners.tolist()))
+    ]
+    counts = np.array([len(phonemes) for phonemes in note_phonemes], dtype=np.int64)
+    ph_seq = list(itertools.chain.from_iterable(note_phonemes))
+    tokens = phonemes_to_tokens(name2token, ph_seq)
+    midi_seq = np.repeat(np.array(midi, dtype=np.int64), counts)
+    midi_dur_seq = np.repeat(np.array(midi_dur, dtype=np.float32), counts)
+    is_slur_seq = np.repeat(is_slur, counts)
+    return ph_seq, tokens[None], midi_seq[None], midi_dur_seq[None], is_slur_seq[None]
 
 
 def rhythm_infer(model: str, providers: list, tokens, midi, midi_dur, is_slur):
-    session = utils.create_session(model, providers)
+    session = utils.session_pool.get(model, providers)
     ph_dur = session.run(['ph_dur'], {'tokens': tokens, 'midi': midi, 'midi_dur': midi_dur, 'is_slur': is_slur})[0]
     return ph_dur
 
 
-def rhythm_postprocess(ph_seq, midi_dur, ph_dur, all_vowels):
-    for i in range(len(ph_dur)):
-        if ph_seq[i] in all_vowels:
-            if i < len(ph_dur) - 1 and ph_seq[i + 1] not in all_vowels:
-                ph_dur[i] = midi_dur[i] - ph_dur[i + 1]
-                if ph_dur[i] < 0:
-                    ph_dur[i] = 0
-                    ph_dur[i + 1] = midi_dur[i]
-            else:
-                ph_dur[i] = midi_dur[i]
+def rhythm_postprocess(ph_seq: list, midi_dur: np.ndarray, ph_dur: np.ndarray, all_vowels: set) -> np.ndarray:
+    """
+    Fit the predicted durations to the notes: a vowel followed by a consonant ends where the consonant
+    takes over the rest of the note, and any other vowel fills its whole note.
+    """
+    midi_dur = midi_dur.astype(np.float64)
+    ph_dur = ph_dur.astype(np.float64)
+    is_vowel = np.array([ph in all_vowels for ph in ph_seq], dtype=np.bool_)
+    before_consonant = np.zeros_like(is_vowel)
+    before_consonant[:-1] = ~is_vowel[1:]
+    fitted = ph_dur.copy()
+    filled = is_vowel & ~before_consonant
+    fitted[filled] = midi_dur[filled]
+    shared = np.flatnonzero(is_vowel & before_consonant)
+    fitted[shared] = midi_dur[shared] - ph_dur[shared + 1]
+    # The consonant takes the whole note if it is longer than the note itself.
+    overflow = shared[fitted[shared] < 0]
+    fitted[overflow] = 0
+    fitted[overflow + 1] = midi_dur[overflow]
+    return fitted
 
 
-def predict_rhythm(notes: list, name2token: list, all_vowels: set, configs: dict):
-    tokens, midi_seq, midi_dur_seq, is_slur_seq = rhythm_preprocess(
+def merge_slurs(ph_seq: list, ph_dur: np.ndarray, is_slur: np.ndarray):
+    """
+    Merge the duration of every slur into the phoneme it continues and drop the slurs from the sequence.
+    """
+    ph_dur = ph_dur.copy()
+    owners = np.maximum.accumulate(np.where(is_slur, -1, np.arange(len(ph_seq))))
+    # Leading slurs have no phoneme before them and are merged into the last one.
+    leading = is_slur & (owners < 0)
+    np.add.at(ph_dur, np.full(np.count_nonzero(leading), len(ph_seq) - 1), ph_dur[leading])
+    trailing = is_slur & (owners >= 0)
+    np.add.at(ph_dur, owners[trailing], ph_dur[trailing])
+    keep = ~is_slur
+    return list(itertools.compress(ph_seq, keep.tolist())), ph_dur[keep].tolist()
+
+
+def rhythm_infer_batch(model: str, providers: list, items: list):
+    """
+    Run the rhythmizer on several (tokens, midi, midi_dur, is_slur) items at once.
+    Items are zero-padded to a common length and the durations of each item are cut back to its own length.
+    """
+    session = utils.session_pool.get(model, providers)
+    max_tokens = max(item[0].shape[0] for item in items)
+    tokens = np.zeros((len(items), max_tokens), dtype=np.int64)
+    midi = np.zeros((len(items), max_tokens), dtype=np.int64)
+    midi_dur = np.zeros((len(items), max_tokens), dtype=np.float32)
+    is_slur = np.zeros((len(items), max_tokens), dtype=np.bool_)
+    for i, (tok, mid, mid_dur, slur) in enumerate(items):
+        tokens[i, :tok.shape[0]] = tok
+        midi[i, :mid.shape[0]] = mid
+        midi_dur[i, :mid_dur.shape[0]] = mid_dur
+        is_slur[i, :slur.shape[0]] = slur
+    ph_dur = session.run(['ph_dur'], {'tokens': tokens, 'midi': midi, 'midi_dur': midi_dur, 'is_slur': is_slur})[0]
+    return [ph_dur[i, :item[0].shape[0]] for i, item in enumerate(items)]
+
+
+def _preprocess_notes(notes: list, name2token: dict):
+    return rhythm_preprocess(
         name2token=name2token,
         words=[note.get('phonemes') for note in notes],
         midi=[note['key'] for note in notes],
         midi_dur=[note['duration'] for note in notes],
         is_slur=[note['slur'] for note in notes]
     )
-    ph_dur = rhythm_infer(
-        model=configs['rhythmizer']['filename'], providers=configs['providers'],
-        tokens=tokens, midi=midi_seq, midi_dur=midi_dur_seq, is_slur=is_slur_seq
-    )
-    ph_seq = [name2token[tok] for tok in tokens[0].tolist()]
-    midi_seq = midi_seq[0].tolist()
-    midi_dur_seq = midi_dur_seq[0].tolist()
-    is_slur_seq = is_slur_seq[0].tolist()
-    ph_dur = ph_dur[0].tolist()
-    rhythm_postprocess(
+
+
+def _postprocess_rhythm(ph_seq: list, midi_dur_seq, is_slur_seq, ph_dur, all_vowels: set):
+    ph_dur = rhythm_postprocess(
         ph_seq=ph_seq, midi_dur=midi_dur_seq,
         ph_dur=ph_dur, all_vowels=all_vowels
     )
-    i = 0
-    while i < len(ph_seq):
-        if is_slur_seq[i]:
-            ph_dur[i - 1] += ph_dur[i]
-            ph_seq.pop(i)
-            midi_seq.pop(i)
-            midi_dur_seq.pop(i)
-            is_slur_seq.pop(i)
-            ph_dur.pop(i)
+    return merge_slurs(ph_seq, ph_dur, is_slur_seq)
+
+
+def predict_rhythm(notes: list, name2token: dict, all_vowels: set, configs: dict):
+    with metrics.stage('rhythm_preprocess'):
+        ph_seq, tokens, midi_seq, midi_dur_seq, is_slur_seq = _preprocess_notes(notes, name2token)
+    with metrics.stage('rhythm'):
+        ph_dur = rhythm_infer(
+            model=configs['rhythmizer']['filename'], providers=configs['providers'],
+            tokens=tokens, midi=midi_seq, midi_dur=midi_dur_seq, is_slur=is_slur_seq
+        )
+    with metrics.stage('rhythm_postprocess'):
+        return _postprocess_rhythm(ph_seq, midi_dur_seq[0], is_slur_seq[0], ph_dur[0], all_vowels)
+
+
+def notes_to_token(notes: list) -> str:
+    """
+    Hash a note sequence by the fields the rhythmizer sees. The phonemes of slurs are ignored.
+    """
+    return utils.request_to_token([
+        [int(note['key']), float(note['duration']), bool(note['slur']),
+         None if note['slur'] else list(note['phonemes'])]
+        for note in notes
+    ])
+
+
+def predict_rhythm_batch(phrases: list, name2token: dict, all_vowels: set, configs: dict, memo=None):
+    """
+    Predict the rhythm of several note sequences, returning (ph_seq, ph_dur) for each of them.
+    Identical phrases are predicted once, results are kept in `memo` (by dictionary, rhythmizer and notes) if
+    given, and the remaining phrases are sorted by length and run through the rhythmizer in padded batches of
+    rhythmizer.max_batch_size.
+    """
+    model = configs['rhythmizer']['filename']
+    namespace = (configs['dictionary']['filename'], configs['dictionary']['reserved_tokens'], model)
+    keys = [notes_to_token(notes) for notes in phrases]
+    results = {}
+    pending = {}
+    for key, notes in zip(keys, phrases):
+        if key in results or key in pending:
+            continue
+        result = memo.get((namespace, key)) if memo is not None else None
+        if result is not None:
+            results[key] = result
         else:
-            i += 1
-    return ph_seq, ph_dur
+            with metrics.stage('rhythm_preprocess'):
+                pending[key] = _preprocess_notes(notes, name2token)
+    # Phrases of similar lengths share a batch to keep padding low.
+    order = sorted(pending, key=lambda k: pending[k][1].shape[1])
+    batch_size = max(configs['rhythmizer']['max_batch_size'], 1)
+    for i in range(0, len(order), batch_size):
+        batch = order[i:i + batch_size]
+        with metrics.stage('rhythm'):
+            ph_durs = rhythm_infer_batch(
+                model=model, providers=configs['providers'],
+                items=[tuple(seq[0] for seq in pending[key][1:]) for key in batch]
+            )
+        for key, ph_dur in zip(batch, ph_durs):
+            ph_seq, _, _, midi_dur_seq, is_slur_seq = pending[key]
+            with metrics.stage('rhythm_postprocess'):
+                results[key] = _postprocess_rhythm(ph_seq, midi_dur_seq[0], is_slur_seq[0], ph_dur, all_vowels)
+            if memo is not None:
+                memo.put((namespace, key), results[key])
+    return [results[key] for key in keys]
 
 
-def acoustic_preprocess(name2token: list,
+def acoustic_preprocess(name2token: dict,
                         phonemes: list,
                         durations: list,
                         f0: list,
                         frame_length: float,
                         f0_timestep: float):
-    tokens = [name2token.index(ph) for ph in phonemes]
-    tokens = np.array(tokens, dtype=np.int64)
+    tokens = phonemes_to_tokens(name2token, phonemes)
 
     ph_dur = np.array(durations)
     ph_acc = np.around(np.add.accumulate(ph_dur) / frame_length + 0.5).astype(np.int64)
@@ -116,33 +213,332 @@ def acoustic_preprocess(name2token: list,
 
 
 def acoustic_infer(model: str, providers: list, tokens, durations, f0, speedup):
-    session = utils.create_session(model, providers)
+    session = utils.session_pool.get(model, providers)
     mel = session.run(['mel'], {'tokens': tokens, 'durations': durations, 'f0': f0, 'speedup': speedup})[0]
     return mel
 
 
 def vocoder_infer(model: str, providers: list, mel, f0, force_on_cpu=True):
-    session = utils.create_session(model, providers, force_on_cpu=force_on_cpu)
+    session = utils.session_pool.get(model, providers, force_on_cpu=force_on_cpu)
     waveform = session.run(['waveform'], {'mel': mel, 'f0': f0})[0]
     return waveform
 
 
-def run_synthesis(request: dict, name2token: list, acoustic: str, configs: dict):
-    tokens, durations, f0 = acoustic_preprocess(
-        name2token=name2token,
-        phonemes=[ph['name'] for ph in request['phonemes']],
-        durations=[ph['duration'] for ph in request['phonemes']],
-        f0=request['f0']['values'],
-        frame_length=configs['vocoder']['hop_size'] / configs['vocoder']['sample_rate'],
-        f0_timestep=request['f0']['timestep']
-    )
-    speedup = np.array(request['speedup'], dtype=np.int64)
-    mel = acoustic_infer(
-        model=acoustic, providers=configs['providers'],
-        tokens=tokens, durations=durations, f0=f0, speedup=speedup
+def acoustic_infer_batch(model: str, providers: list, items: list, speedup):
+    """
+    Run the acoustic model on several (tokens, durations, f0) items at once.
+    Items are padded to a common length and the mel of each item is cut back to its own frame count. The model
+    takes no lengths or masks, so this assumes that padded positions do not leak into the frames of an item
+    (see tests/test_batching.py).
+    """
+    session = utils.session_pool.get(model, providers)
+    max_tokens = max(item[0].shape[0] for item in items)
+    max_frames = max(item[2].shape[0] for item in items)
+    tokens = np.zeros((len(items), max_tokens), dtype=np.int64)
+    durations = np.zeros((len(items), max_tokens), dtype=np.int64)
+    f0 = np.zeros((len(items), max_frames), dtype=np.float32)
+    for i, (tok, dur, f0_seq) in enumerate(items):
+        tokens[i, :tok.shape[0]] = tok
+        durations[i, :dur.shape[0]] = dur
+        f0[i] = np.pad(f0_seq, (0, max_frames - f0_seq.shape[0]), mode='edge')
+    mel = session.run(['mel'], {'tokens': tokens, 'durations': durations, 'f0': f0, 'speedup': speedup})[0]
+    return [mel[i, :item[2].shape[0]] for i, item in enumerate(items)]
+
+
+def vocoder_infer_batch(model: str, providers: list, items: list, hop_size: int, force_on_cpu=True):
+    """
+    Run the vocoder on several (mel, f0) items at once.
+    Items are edge-padded to a common length and the waveform of each item is cut back to its own length,
+    under the same assumption as `acoustic_infer_batch`.
+    """
+    session = utils.session_pool.get(model, providers, force_on_cpu=force_on_cpu)
+    max_frames = max(item[1].shape[0] for item in items)
+    mel = np.stack([np.pad(m, ((0, max_frames - m.shape[0]), (0, 0)), mode='edge') for m, _ in items])
+    f0 = np.stack([np.pad(f, (0, max_frames - f.shape[0]), mode='edge') for _, f in items])
+    waveform = session.run(['waveform'], {'mel': mel, 'f0': f0})[0]
+    return [waveform[i, :item[1].shape[0] * hop_size] for i, item in enumerate(items)]
+
+
+def vocoder_infer_chunked(model: str, providers: list, mel, f0, hop_size: int,
+                          chunk_frames: int, overlap_frames: int, force_on_cpu=True):
+    """
+    Run the vocoder over overlapping windows of `chunk_frames + overlap_frames` frames and yield the
+    waveform chunk by chunk. The overlapping part of two neighbouring windows is linearly crossfaded.
+    """
+    session = utils.session_pool.get(model, providers, force_on_cpu=force_on_cpu)
+    total_frames = mel.shape[1]
+    fade_in = np.linspace(0., 1., overlap_frames * hop_size, dtype=np.float32)
+    tail = None
+    start = 0
+    while start < total_frames:
+        end = min(total_frames, start + chunk_frames + overlap_frames)
+        with metrics.stage('vocoder'):
+            waveform = session.run(['waveform'], {'mel': mel[:, start:end], 'f0': f0[:, start:end]})[0][0]
+        if tail is not None:
+            fade = fade_in[:tail.shape[0]]
+            waveform[:tail.shape[0]] = tail * (1. - fade) + waveform[:tail.shape[0]] * fade
+        if end >= total_frames:
+            yield waveform
+            return
+        keep = chunk_frames * hop_size
+        yield waveform[:keep]
+        tail = waveform[keep:]
+        start += chunk_frames
+
+
+def create_batchers(configs: dict) -> dict:
+    batch_config = configs['batching']
+
+    def run_acoustic(key, items):
+        model, speedup = key
+        return acoustic_infer_batch(model, configs['providers'], items, np.array(speedup, dtype=np.int64))
+
+    def run_vocoder(key, items):
+        return vocoder_infer_batch(
+            key, configs['providers'], items, configs['vocoder']['hop_size'],
+            force_on_cpu=configs['vocoder']['force_on_cpu']
+        )
+
+    return {
+        name: batching.MicroBatcher(
+            run, window=batch_config['window'] / 1000, max_batch_size=batch_config['max_batch_size'],
+            bucket_ratio=batch_config['bucket_ratio'], name=name
+        )
+        for name, run in [('acoustic', run_acoustic), ('vocoder', run_vocoder)]
+    }
+
+
+def preprocess_request(request: dict, name2token: dict, configs: dict, stage: str = 'preprocess'):
+    """
+    Turn a request into the frame-level inputs of the acoustic model, timed as `stage`.
+    """
+    with metrics.stage(stage):
+        return acoustic_preprocess(
+            name2token=name2token,
+            phonemes=[ph['name'] for ph in request['phonemes']],
+            durations=[ph['duration'] for ph in request['phonemes']],
+            f0=request['f0']['values'],
+            frame_length=configs['vocoder']['hop_size'] / configs['vocoder']['sample_rate'],
+            f0_timestep=request['f0']['timestep']
+        )
+
+
+def request_token(request: dict, name2token: dict, configs: dict) -> str:
+    """
+    Hash a request by what the models see of it: the model, the vocoder, the speedup (acoustic.speedup if absent)
+    and the frame-level inputs produced by `preprocess_request`. Requests that differ only in float formatting,
+    in f0 samples past the last phoneme or in spelling out the default speedup share a token.
+    """
+    return canonicalize_request(request, name2token, configs)[0]
+
+
+def canonicalize_request(request: dict, name2token: dict, configs: dict) -> tuple:
+    """
+    Return the token of a request (see `request_token`) together with the frame-level inputs it hashes,
+    which the synthesis functions take as `inputs` instead of preprocessing the request again.
+    """
+    inputs = preprocess_request(request, name2token, configs, stage='canonicalize')
+    token = utils.tensors_to_token(
+        request['model'], os.path.basename(configs['vocoder']['filename']),
+        int(request.get('speedup', configs['acoustic']['speedup'])), *inputs
     )
-    waveform = vocoder_infer(
+    return token, inputs
+
+
+def _run_acoustic(acoustic: str, tokens, durations, f0, speedup: int, configs: dict,
+                  batchers: dict = None, mel_cache=None):
+    if mel_cache is not None:
+        key = utils.tensors_to_token(os.path.basename(acoustic), speedup, tokens, durations, f0)
+        mel = mel_cache.get(key)
+        if mel is not None:
+            return mel
+    with metrics.stage('acoustic'):
+        if batchers is not None:
+            mel = batchers['acoustic'].submit(
+                (acoustic, speedup), (tokens[0], durations[0], f0[0]), f0.shape[1]
+            ).result()[None]
+        else:
+            mel = acoustic_infer(
+                model=acoustic, providers=configs['providers'],
+                tokens=tokens, durations=durations, f0=f0, speedup=np.array(speedup, dtype=np.int64)
+            )
+    if mel_cache is not None:
+        mel_cache.put(key, mel)
+    return mel
+
+
+def _run_vocoder(mel, f0, configs: dict, batchers: dict = None):
+    with metrics.stage('vocoder'):
+        if batchers is not None:
+            return batchers['vocoder'].submit(configs['vocoder']['filename'], (mel[0], f0[0]), f0.shape[1]).result()
+        waveform = vocoder_infer(
+            model=configs['vocoder']['filename'], providers=configs['providers'], mel=mel, f0=f0,
+            force_on_cpu=configs['vocoder']['force_on_cpu']
+        )
+        return waveform[0]
+
+
+def diffusion_steps(configs: dict, speedup: int) -> int:
+    return max(configs['acoustic']['diffusion_steps'] // speedup, 1)
+
+
+def run_synthesis(request: dict, name2token: dict, acoustic: str, configs: dict,
+                  batchers: dict = None, mel_cache=None, progress=None, inputs: tuple = None):
+    """
+    Synthesize a whole request in one shot. `progress(done, total)`, if given,
+    is called with the number of diffusion steps finished. `inputs`, if given, are the
+    tensors of `preprocess_request` for the request, which is then not preprocessed again.
+    """
+    tokens, durations, f0 = inputs if inputs is not None else preprocess_request(request, name2token, configs)
+    speedup = int(request['speedup'])
+    mel = _run_acoustic(acoustic, tokens, durations, f0, speedup, configs, batchers, mel_cache)
+    if progress is not None:
+        steps = diffusion_steps(configs, speedup)
+        progress(steps, steps)
+    return _run_vocoder(mel, f0, configs, batchers)
+
+
+def stream_synthesis(request: dict, name2token: dict, acoustic: str, configs: dict,
+                     batchers: dict = None, mel_cache=None, progress=None, inputs: tuple = None):
+    """
+    Same as run_synthesis, but vocode in overlapping chunks and yield the waveform progressively.
+    """
+    tokens, durations, f0 = inputs if inputs is not None else preprocess_request(request, name2token, configs)
+    speedup = int(request['speedup'])
+    mel = _run_acoustic(acoustic, tokens, durations, f0, speedup, configs, batchers, mel_cache)
+    if progress is not None:
+        steps = diffusion_steps(configs, speedup)
+        progress(steps, steps)
+    yield from vocoder_infer_chunked(
         model=configs['vocoder']['filename'], providers=configs['providers'], mel=mel, f0=f0,
-        force_on_cpu=configs['vocoder']['force_on_cpu']
+        hop_size=configs['vocoder']['hop_size'], chunk_frames=configs['vocoder']['chunk_frames'],
+        overlap_frames=configs['vocoder']['chunk_overlap'], force_on_cpu=configs['vocoder']['force_on_cpu']
+    )
+
+
+def split_phrases(phonemes: list) -> list:
+    """
+    Return the phoneme indices at which the sequence splits into phrases: the sequence is cut
+    before every rest (SP/AP) that follows a non-rest phoneme, so each phrase begins with its rests.
+    """
+    bounds = [0]
+    for i in range(1, len(phonemes)):
+        if phonemes[i] in REST_PHONEMES and phonemes[i - 1] not in REST_PHONEMES:
+            bounds.append(i)
+    bounds.append(len(phonemes))
+    return bounds
+
+
+def plan_segments(phonemes: list, frame_bounds: np.ndarray, max_frames: int) -> list:
+    """
+    Group consecutive phrases into segments of at most `max_frames` frames and return the (start, end)
+    phoneme ranges of the segments. A phrase longer than `max_frames` makes a segment of its own,
+    and every phrase is a segment of its own if `max_frames` is 0. Segments without frames are left out.
+    """
+    phrase_bounds = split_phrases(phonemes)
+    segments = []
+    for start, end in zip(phrase_bounds[:-1], phrase_bounds[1:]):
+        if segments and frame_bounds[end] - frame_bounds[segments[-1][0]] <= max_frames:
+            segments[-1] = (segments[-1][0], end)
+        else:
+            segments.append((start, end))
+    return [(start, end) for start, end in segments if frame_bounds[end] > frame_bounds[start]]
+
+
+def _segment_inputs(tokens, durations, f0, frame_bounds: np.ndarray, frame_start: int, frame_end: int):
+    """
+    Cut the inputs of the frames in [frame_start, frame_end). Phonemes crossing the window are clipped to it.
+    """
+    first = np.searchsorted(frame_bounds[1:], frame_start, side='right')
+    last = np.searchsorted(frame_bounds[:-1], frame_end, side='left')
+    seg_durations = (
+        np.minimum(frame_bounds[first + 1:last + 1], frame_end) - np.maximum(frame_bounds[first:last], frame_start)
     )
-    return waveform[0]
+    return tokens[:, first:last], seg_durations[None].astype(durations.dtype), f0[:, frame_start:frame_end]
+
+
+def _ordered_results(executor, fn, items: list, window: int):
+    """
+    Run `fn` over `items` on `executor` with at most `window` calls in flight and yield results in order.
+    """
+    pending = collections.deque()
+    items = iter(items)
+    try:
+        for item in itertools.islice(items, window):
+            pending.append(metrics.run_in_context(executor, fn, item))
+        while pending:
+            result = pending.popleft().result()
+            for item in itertools.islice(items, 1):
+                pending.append(metrics.run_in_context(executor, fn, item))
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def segmented_synthesis(request: dict, name2token: dict, acoustic: str, configs: dict,
+                        segment_cache=None, batchers: dict = None, mel_cache=None, progress=None, executor=None,
+                        inputs: tuple = None):
+    """
+    Synthesize a request segment by segment and yield the waveform progressively.
+    Segments are groups of phrases of up to segmentation.max_frames frames. Neighbouring segments meet in the
+    middle of the rests leading the later one, and both are synthesized with up to segmentation.overlap frames
+    of context past that point, but no more than half the rest, so that the crossfade over their shared
+    context never blends voiced audio. Segments run concurrently on `executor` if given. The waveform of
+    every segment is kept in `segment_cache` under a hash of its inputs, acoustic model, speedup and vocoder,
+    so that an edit only re-synthesizes the segments it touches. `inputs` is as in run_synthesis.
+    """
+    seg_config = configs['segmentation']
+    hop_size = configs['vocoder']['hop_size']
+    tokens, durations, f0 = inputs if inputs is not None else preprocess_request(request, name2token, configs)
+    speedup = int(request['speedup'])
+    steps = diffusion_steps(configs, speedup)
+    model_name = os.path.basename(acoustic)
+    vocoder_name = os.path.basename(configs['vocoder']['filename'])
+    frame_bounds = np.concatenate(([0], np.cumsum(durations[0])))
+    total_frames = int(frame_bounds[-1])
+    overlap = seg_config['overlap']
+    names = [ph['name'] for ph in request['phonemes']]
+    segments = plan_segments(names, frame_bounds, seg_config['max_frames'])
+    # (frame, context) of the points where neighbouring segments meet
+    seams = [(0, 0)]
+    for start, end in segments[1:]:
+        rest_end = start
+        while rest_end < end and names[rest_end] in REST_PHONEMES:
+            rest_end += 1
+        rest_frames = int(frame_bounds[rest_end] - frame_bounds[start])
+        seams.append((int(frame_bounds[start]) + rest_frames // 2, min(overlap, rest_frames // 2)))
+    seams.append((total_frames, 0))
+    # Frame windows synthesized for each segment, including the context
+    windows = [(seams[i][0] - seams[i][1], seams[i + 1][0] + seams[i + 1][1]) for i in range(len(segments))]
+
+    def render(window: tuple):
+        seg_tokens, seg_durations, seg_f0 = _segment_inputs(tokens, durations, f0, frame_bounds, *window)
+        key = utils.tensors_to_token(model_name, vocoder_name, speedup, seg_tokens, seg_durations, seg_f0)
+        waveform = segment_cache.get(key) if segment_cache is not None else None
+        if waveform is None:
+            mel = _run_acoustic(acoustic, seg_tokens, seg_durations, seg_f0, speedup, configs, batchers, mel_cache)
+            waveform = _run_vocoder(mel, seg_f0, configs, batchers)
+            if segment_cache is not None:
+                segment_cache.put(key, waveform)
+        return waveform
+
+    if executor is None:
+        waveforms = map(render, windows)
+    else:
+        waveforms = _ordered_results(executor, render, windows, seg_config['workers'] * 2)
+    tail = None
+    for i, waveform in enumerate(waveforms):
+        if tail is not None:
+            length = min(tail.shape[0], waveform.shape[0])
+            fade = np.linspace(0., 1., length, dtype=np.float32)
+            waveform = waveform.copy()
+            waveform[:length] = tail[:length] * (1. - fade) + waveform[:length] * fade
+        if progress is not None:
+            progress((i + 1) * steps, len(windows) * steps)
+        if i == len(windows) - 1:
+            yield waveform
+        else:
+            keep = (windows[i + 1][0] - windows[i][0]) * hop_size
+            yield waveform[:keep]
+            tail = waveform[keep:]
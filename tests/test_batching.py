@@ -0,0 +1,85 @@
+"""
+Batched inference must give every item the same output as running it alone.
+
+The acoustic model and vocoder take no lengths or masks, so batching relies on padded positions not leaking
+into the frames of an item. The synthetic stand-in models of benchmark.py are frame-wise, which isolates the
+padding and slicing done by synthesis.py and batching.py.
+"""
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip('onnx')
+
+import batching  # noqa: E402
+import benchmark  # noqa: E402
+import synthesis  # noqa: E402
+
+NUM_MEL_BINS = 16
+HOP_SIZE = 32
+PROVIDERS = [{'name': 'CPUExecutionProvider', 'options': {}}]
+LENGTHS = [1, 7, 50, 51, 200]
+
+
+@pytest.fixture(scope='module')
+def models(tmp_path_factory):
+    return benchmark.create_synthetic_models(str(tmp_path_factory.mktemp('models')), NUM_MEL_BINS, HOP_SIZE)
+
+
+def _acoustic_items(rng: np.random.Generator) -> list:
+    items = []
+    for frames in LENGTHS:
+        count = max(frames // 10, 1)
+        durations = np.diff(np.linspace(0, frames, count + 1).astype(np.int64))
+        items.append((rng.integers(3, 60, count), durations, rng.uniform(100., 800., frames).astype(np.float32)))
+    return items
+
+
+def test_acoustic_batch_matches_single(models):
+    items = _acoustic_items(np.random.default_rng(0))
+    speedup = np.array(10, dtype=np.int64)
+    batched = synthesis.acoustic_infer_batch(models['acoustic'], PROVIDERS, items, speedup)
+    for (tokens, durations, f0), mel in zip(items, batched):
+        single = synthesis.acoustic_infer(models['acoustic'], PROVIDERS, tokens[None], durations[None], f0[None],
+                                          speedup)[0]
+        assert mel.shape == single.shape
+        np.testing.assert_allclose(mel, single, rtol=1e-6, atol=1e-7)
+
+
+def test_vocoder_batch_matches_single(models):
+    rng = np.random.default_rng(1)
+    items = [
+        (rng.standard_normal((frames, NUM_MEL_BINS)).astype(np.float32),
+         rng.uniform(100., 800., frames).astype(np.float32))
+        for frames in LENGTHS
+    ]
+    batched = synthesis.vocoder_infer_batch(models['vocoder'], PROVIDERS, items, HOP_SIZE)
+    for (mel, f0), waveform in zip(items, batched):
+        single = synthesis.vocoder_infer(models['vocoder'], PROVIDERS, mel[None], f0[None])[0]
+        assert waveform.shape == single.shape == (mel.shape[0] * HOP_SIZE,)
+        np.testing.assert_allclose(waveform, single, rtol=1e-6, atol=1e-7)
+
+
+def test_micro_batcher_returns_results_to_their_items(models):
+    items = _acoustic_items(np.random.default_rng(2))
+    speedup = np.array(10, dtype=np.int64)
+    batcher = batching.MicroBatcher(
+        lambda key, batch: synthesis.acoustic_infer_batch(key, PROVIDERS, batch, speedup),
+        window=0.05, max_batch_size=4, bucket_ratio=100., name='test'
+    )
+    with ThreadPoolExecutor(len(items)) as executor:
+        futures = [
+            executor.submit(lambda item: batcher.submit(models['acoustic'], item, item[2].shape[0]).result(), item)
+            for item in items
+        ]
+        results = [future.result(timeout=30) for future in futures]
+    assert batcher.stats()['batches'] < len(items)
+    for (tokens, durations, f0), mel in zip(items, results):
+        single = synthesis.acoustic_infer(models['acoustic'], PROVIDERS, tokens[None], durations[None], f0[None],
+                                          speedup)[0]
+        np.testing.assert_allclose(mel, single, rtol=1e-6, atol=1e-7)
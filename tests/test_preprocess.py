@@ -0,0 +1,200 @@
+"""
+Regression tests for the vectorized preprocessing in synthesis.py.
+
+The reference functions below are the loop implementations the vectorized ones replaced, kept verbatim apart
+from their names. Random phrases built from the bundled dictionary must give exactly the same results.
+"""
+import os
+import random
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthesis  # noqa: E402
+import utils  # noqa: E402
+
+DICTIONARY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          'assets', 'dictionaries', 'opencpop-strict.txt')
+RESERVED_TOKENS = 3
+FRAME_LENGTH = 512 / 44100
+CASES = 500
+
+
+def _reference_rhythm_preprocess(name2token: list, words: list, midi: list, midi_dur: list, is_slur: list):
+    tokens = []
+    midi_seq = []
+    midi_dur_seq = []
+    is_slur_seq = []
+    last_phoneme = 'SP'
+    for i in range(len(words)):
+        if not is_slur[i]:
+            for ph in words[i]:
+                tokens.append(name2token.index(ph))
+                midi_seq.append(midi[i])
+                midi_dur_seq.append(midi_dur[i])
+                is_slur_seq.append(False)
+            last_phoneme = words[i][-1]
+        else:
+            tokens.append(name2token.index(last_phoneme))
+            midi_seq.append(midi[i])
+            midi_dur_seq.append(midi_dur[i])
+            is_slur_seq.append(True)
+    tokens = np.array(tokens, dtype=np.int64)
+    midi_seq = np.array(midi_seq, dtype=np.int64)
+    midi_dur_seq = np.array(midi_dur_seq, dtype=np.float32)
+    is_slur_seq = np.array(is_slur_seq, dtype=np.bool_)
+    return tokens[None], midi_seq[None], midi_dur_seq[None], is_slur_seq[None]
+
+
+def _reference_rhythm_postprocess(ph_seq, midi_dur, ph_dur, all_vowels):
+    for i in range(len(ph_dur)):
+        if ph_seq[i] in all_vowels:
+            if i < len(ph_dur) - 1 and ph_seq[i + 1] not in all_vowels:
+                ph_dur[i] = midi_dur[i] - ph_dur[i + 1]
+                if ph_dur[i] < 0:
+                    ph_dur[i] = 0
+                    ph_dur[i + 1] = midi_dur[i]
+            else:
+                ph_dur[i] = midi_dur[i]
+
+
+def _reference_merge_slurs(ph_seq: list, ph_dur: list, is_slur_seq: list):
+    # The tail of the baseline predict_rhythm.
+    i = 0
+    while i < len(ph_seq):
+        if is_slur_seq[i]:
+            ph_dur[i - 1] += ph_dur[i]
+            ph_seq.pop(i)
+            is_slur_seq.pop(i)
+            ph_dur.pop(i)
+        else:
+            i += 1
+    return ph_seq, ph_dur
+
+
+def _reference_acoustic_preprocess(name2token: list, phonemes: list, durations: list, f0: list,
+                                   frame_length: float, f0_timestep: float):
+    tokens = [name2token.index(ph) for ph in phonemes]
+    tokens = np.array(tokens, dtype=np.int64)
+
+    ph_dur = np.array(durations)
+    ph_acc = np.around(np.add.accumulate(ph_dur) / frame_length + 0.5).astype(np.int64)
+    ph_dur = np.diff(ph_acc, prepend=0)
+
+    t_max = (len(f0) - 1) * f0_timestep
+    f0_seq = np.interp(
+        np.arange(0, t_max, frame_length, dtype=np.float32),
+        f0_timestep * np.arange(len(f0), dtype=np.float32),
+        np.array(f0, dtype=np.float32)
+    ).astype(np.float32)
+    required_length = ph_dur.sum()
+    actual_length = f0_seq.shape[0]
+    if actual_length > required_length:
+        f0_seq = f0_seq[:required_length]
+    elif actual_length < required_length:
+        f0_seq = np.concatenate((f0_seq, np.full((required_length - actual_length,), fill_value=f0_seq[-1])))
+
+    return tokens[None], ph_dur[None], f0_seq[None]
+
+
+@pytest.fixture(scope='module')
+def dictionary():
+    dictionary = utils.load_dictionary(DICTIONARY)
+    phonemes = utils.dictionary_to_phonemes(dictionary, RESERVED_TOKENS)
+    return dictionary, phonemes, utils.phonemes_to_index(phonemes), utils.dictionary_to_vowels(dictionary)
+
+
+def _random_notes(rng: random.Random, dictionary: dict) -> list:
+    syllables = list(dictionary.values()) + [['SP'], ['AP']]
+    count = rng.randint(1, 12)
+    # Some phrases start with slurs, which continue SP in the reference implementation.
+    leading = rng.choice([0, 0, 0, 1, 2])
+    notes = []
+    for i in range(count):
+        slur = i < leading or (i > 0 and rng.random() < 0.3)
+        notes.append({
+            'key': rng.randint(40, 80),
+            'duration': rng.choice([rng.uniform(0.05, 2.), rng.uniform(0.001, 0.05)]),
+            'slur': slur,
+            'phonemes': None if slur else rng.choice(syllables)
+        })
+    return notes
+
+
+def test_rhythm_preprocess_matches_reference(dictionary):
+    rules, phonemes, index, _ = dictionary
+    rng = random.Random(0)
+    for _ in range(CASES):
+        notes = _random_notes(rng, rules)
+        args = dict(
+            words=[note['phonemes'] for note in notes],
+            midi=[note['key'] for note in notes],
+            midi_dur=[note['duration'] for note in notes],
+            is_slur=[note['slur'] for note in notes]
+        )
+        expected = _reference_rhythm_preprocess(phonemes, **args)
+        ph_seq, *actual = synthesis.rhythm_preprocess(index, **args)
+        assert ph_seq == [phonemes[token] for token in expected[0][0].tolist()]
+        for a, e in zip(actual, expected):
+            assert a.dtype == e.dtype
+            np.testing.assert_array_equal(a, e)
+
+
+def test_rhythm_postprocess_matches_reference(dictionary):
+    rules, phonemes, index, vowels = dictionary
+    rng = random.Random(1)
+    for _ in range(CASES):
+        notes = _random_notes(rng, rules)
+        ph_seq, _, _, midi_dur_seq, is_slur_seq = synthesis.rhythm_preprocess(
+            index,
+            words=[note['phonemes'] for note in notes],
+            midi=[note['key'] for note in notes],
+            midi_dur=[note['duration'] for note in notes],
+            is_slur=[note['slur'] for note in notes]
+        )
+        # Predicted durations that are sometimes longer than their notes, so that consonants overflow.
+        ph_dur = np.array([rng.uniform(0., 0.6) for _ in ph_seq], dtype=np.float32)
+
+        expected_dur = ph_dur.tolist()
+        _reference_rhythm_postprocess(list(ph_seq), midi_dur_seq[0].tolist(), expected_dur, vowels)
+        fitted = synthesis.rhythm_postprocess(ph_seq, midi_dur_seq[0], ph_dur, vowels)
+        assert fitted.tolist() == expected_dur
+
+        expected = _reference_merge_slurs(list(ph_seq), expected_dur, is_slur_seq[0].tolist())
+        assert synthesis.merge_slurs(ph_seq, fitted, is_slur_seq[0]) == expected
+
+
+def test_acoustic_preprocess_matches_reference(dictionary):
+    _, phonemes, index, _ = dictionary
+    names = [ph for ph in phonemes if ph is not None]
+    rng = random.Random(2)
+    for _ in range(CASES):
+        count = rng.randint(1, 40)
+        durations = [rng.uniform(0.001, 1.) for _ in range(count)]
+        f0_timestep = rng.choice([0.005, 0.01, FRAME_LENGTH])
+        # f0 curves both shorter and longer than the phonemes.
+        f0 = [rng.uniform(100., 800.) for _ in range(max(2, int(sum(durations) / f0_timestep * rng.uniform(0.5, 1.5))))]
+        args = dict(
+            phonemes=[rng.choice(names) for _ in range(count)],
+            durations=durations, f0=f0, frame_length=FRAME_LENGTH, f0_timestep=f0_timestep
+        )
+        expected = _reference_acoustic_preprocess(phonemes, **args)
+        actual = synthesis.acoustic_preprocess(index, **args)
+        for a, e in zip(actual, expected):
+            assert a.dtype == e.dtype
+            np.testing.assert_array_equal(a, e)
+
+
+def test_unknown_phonemes_are_rejected(dictionary):
+    _, _, index, _ = dictionary
+    with pytest.raises(utils.PhonemeError, match='^Unknown phonemes: xx, yy.$'):
+        synthesis.phonemes_to_tokens(index, ['SP', 'yy', 'a', 'xx', 'yy'])
+    with pytest.raises(utils.PhonemeError, match='xx'):
+        synthesis.rhythm_preprocess(index, [['SP'], ['sh', 'a'], ['xx']], [0, 60, 62], [0.5, 0.5, 0.5],
+                                    [False, False, False])
+    with pytest.raises(utils.PhonemeError, match='xx, yy'):
+        synthesis.acoustic_preprocess(index, phonemes=['SP', 'xx', 'a', 'yy'], durations=[0.1] * 4, f0=[440.] * 50,
+                                      frame_length=FRAME_LENGTH, f0_timestep=0.01)
@@ -1,12 +1,19 @@
+import collections
 import hashlib
 import json
 import logging
 import os
 import random
+import re
+import threading
+import time
 
+import numpy as np
 import onnxruntime as ort
 import yaml
 
+import metrics
+
 _dll_loaded = False
 
 
@@ -15,12 +22,19 @@ class ProviderError(Exception):
         super().__init__(*args)
 
 
+class PhonemeError(Exception):
+    def __init__(self, *args):
+        super().__init__(*args)
+
+
 def load_configs(path: str) -> dict:
     with open(path, 'r', encoding='utf8') as f:
         return yaml.safe_load(f)
 
 
-def create_session(model_path: str, providers: list, force_on_cpu: bool = False) -> ort.InferenceSession:
+def create_session(model_path: str, providers: list, force_on_cpu: bool = False,
+                   intra_op_num_threads: int = 0, inter_op_num_threads: int = 0,
+                   profile_dir: str = None) -> ort.InferenceSession:
     global _dll_loaded
 
     available_providers_selected = []
@@ -42,6 +56,14 @@ def create_session(model_path: str, providers: list, force_on_cpu: bool = False)
 
     # Create session options
     options = ort.SessionOptions()
+    # 0 lets onnxruntime choose the number of threads
+    options.intra_op_num_threads = intra_op_num_threads
+    options.inter_op_num_threads = inter_op_num_threads
+    if profile_dir is not None:
+        # The profile is written when the session ends profiling, see SessionPool.
+        os.makedirs(profile_dir, exist_ok=True)
+        options.enable_profiling = True
+        options.profile_file_prefix = os.path.join(profile_dir, os.path.splitext(os.path.basename(model_path))[0])
     if available_providers_selected[0]['name'] == 'DmlExecutionProvider':
         # DirectML does not support memory pattern optimizations or parallel execution in onnxruntime. See
         # https://onnxruntime.ai/docs/execution-providers/DirectML-ExecutionProvider.html#configuration-options
@@ -66,6 +88,89 @@ def create_session(model_path: str, providers: list, force_on_cpu: bool = False)
     return session
 
 
+class SessionPool:
+    """
+    Thread-safe registry of warm inference sessions keyed by (model path, providers, force_on_cpu).
+    Least recently used sessions are evicted once the count or memory budget is exceeded. Memory
+    usage of a session is estimated by the size of its model file.
+    If `profile_dir` is set, sessions are created with ONNX Runtime profiling enabled and their
+    profiles are dumped into it when they are evicted or the pool is cleared.
+    """
+
+    def __init__(self, max_count: int = 0, max_memory: int = 0):
+        self.max_count = max_count
+        self.max_memory = max_memory
+        self.intra_op_num_threads = 0
+        self.inter_op_num_threads = 0
+        self.profile_dir = None
+        self._sessions = collections.OrderedDict()
+        self._loading = {}
+        self._memory = 0
+        self._mutex = threading.Lock()
+
+    def configure(self, max_count: int = 0, max_memory: int = 0,
+                  intra_op_num_threads: int = 0, inter_op_num_threads: int = 0, profile_dir: str = None):
+        with self._mutex:
+            self.max_count = max_count
+            self.max_memory = max_memory
+            self.intra_op_num_threads = intra_op_num_threads
+            self.inter_op_num_threads = inter_op_num_threads
+            self.profile_dir = profile_dir
+            self._evict()
+
+    def get(self, model_path: str, providers: list, force_on_cpu: bool = False) -> ort.InferenceSession:
+        key = (os.path.abspath(model_path), json.dumps(providers, sort_keys=True), force_on_cpu)
+        with self._mutex:
+            if key in self._sessions:
+                self._sessions.move_to_end(key)
+                return self._sessions[key][0]
+            load_lock = self._loading.setdefault(key, threading.Lock())
+        # Only one thread loads a given session; the others wait and reuse it.
+        with load_lock:
+            with self._mutex:
+                if key in self._sessions:
+                    self._sessions.move_to_end(key)
+                    return self._sessions[key][0]
+            start = time.perf_counter()
+            session = create_session(
+                model_path, providers, force_on_cpu=force_on_cpu,
+                intra_op_num_threads=self.intra_op_num_threads, inter_op_num_threads=self.inter_op_num_threads,
+                profile_dir=self.profile_dir
+            )
+            metrics.SESSION_LOAD_SECONDS.observe(time.perf_counter() - start, model=os.path.basename(model_path))
+            size = os.path.getsize(model_path)
+            with self._mutex:
+                self._sessions[key] = (session, size)
+                self._memory += size
+                self._loading.pop(key, None)
+                self._evict()
+        logging.debug(f'Loaded session for \'{key[0]}\'')
+        return session
+
+    def clear(self):
+        with self._mutex:
+            for key, (session, _) in self._sessions.items():
+                self._end_profiling(key, session)
+            self._sessions.clear()
+            self._memory = 0
+
+    def _evict(self):
+        # The most recently used session is always kept, even if it alone exceeds the budget.
+        while len(self._sessions) > 1 and (
+                0 < self.max_count < len(self._sessions) or 0 < self.max_memory < self._memory):
+            key, (session, size) = self._sessions.popitem(last=False)
+            self._memory -= size
+            self._end_profiling(key, session)
+            logging.debug(f'Evicted session for \'{key[0]}\'')
+
+    def _end_profiling(self, key: tuple, session: ort.InferenceSession):
+        if session.get_session_options().enable_profiling:
+            logging.info(f'Wrote profile of \'{key[0]}\' to \'{session.end_profiling()}\'')
+
+
+session_pool = SessionPool()
+
+
 def load_dictionary(path: str) -> dict:
     with open(path, 'r', encoding='utf8') as f:
         rules = [ln.strip().split('\t') for ln in f.readlines()]
@@ -78,6 +183,13 @@ def dictionary_to_phonemes(dictionary: dict, pad: int) -> list:
     return [None for _ in range(pad)] + sorted(phonemes)
 
 
+def phonemes_to_index(phonemes: list) -> dict:
+    """
+    Map every phoneme of a list returned by `dictionary_to_phonemes` to its token, skipping the reserved tokens.
+    """
+    return {ph: token for token, ph in enumerate(phonemes) if ph is not None}
+
+
 def dictionary_to_vowels(dictionary: dict) -> set:
     vowels = {'AP', 'SP'}
     for ph_list in dictionary.values():
@@ -91,11 +203,111 @@ def dictionary_to_vowels(dictionary: dict) -> set:
     return vowels
 
 
+class PhonemeTable:
+    """
+    Tokens and vowels of the phonemes of a dictionary, as seen by the models trained with it.
+    """
+
+    def __init__(self, dictionary_path: str, reserved_tokens: int):
+        dictionary = load_dictionary(dictionary_path)
+        self.filename = dictionary_path
+        self.reserved_tokens = reserved_tokens
+        self.index = phonemes_to_index(dictionary_to_phonemes(dictionary, reserved_tokens))
+        self.vowels = dictionary_to_vowels(dictionary)
+
+
+class ModelBindings:
+    """
+    Phoneme table and rhythmizer of every acoustic model.
+
+    A model is bound to the dictionary and rhythmizer declared for it under `models` in the config, or else in
+    a sidecar <model>.yaml next to <model>.onnx (with paths relative to the sidecar), and to the default ones
+    otherwise. A model with a dictionary of its own has no rhythmizer (None) unless it declares one as well.
+    Bindings are resolved once per model and models sharing a dictionary share its table. The dictionary and
+    rhythmizer paths of `config` must be absolute; other relative paths of the config are relative to `root`.
+    """
+
+    def __init__(self, config: dict, acoustic_root: str, root: str):
+        self.config = config
+        self.acoustic_root = acoustic_root
+        self.root = root
+        self._tables = {}
+        self._bindings = {}
+        self._mutex = threading.Lock()
+        self.default_table = self._table(config['dictionary']['filename'], config['dictionary']['reserved_tokens'])
+
+    def _table(self, dictionary_path: str, reserved_tokens: int) -> PhonemeTable:
+        key = (dictionary_path, reserved_tokens)
+        if key not in self._tables:
+            self._tables[key] = PhonemeTable(dictionary_path, reserved_tokens)
+            logging.info(f'Loaded dictionary from \'{dictionary_path}\'')
+        return self._tables[key]
+
+    def get(self, model):
+        """
+        Return the phoneme table and the rhythmizer path of an acoustic model, or None if the model does not exist.
+        """
+        with self._mutex:
+            if model in self._bindings:
+                return self._bindings[model]
+            declared = self.config['models'].get(model)
+            root = self.root
+            sidecar = os.path.join(self.acoustic_root, f'{model}.yaml')
+            if declared is None and os.path.exists(sidecar):
+                declared = load_configs(sidecar) or {}
+                root = self.acoustic_root
+                logging.info(f'Found bindings of model \'{model}\' at \'{sidecar}\'')
+            if declared is None:
+                if not os.path.exists(os.path.join(self.acoustic_root, f'{model}.onnx')):
+                    return None
+                declared = {}
+            table, rhythmizer = self.default_table, self.config['rhythmizer']['filename']
+            if 'dictionary' in declared:
+                dict_path = declared['dictionary']['filename']
+                if not os.path.isabs(dict_path):
+                    dict_path = os.path.join(root, dict_path)
+                table = self._table(
+                    dict_path,
+                    declared['dictionary'].get('reserved_tokens', self.config['dictionary']['reserved_tokens'])
+                )
+                if table is not self.default_table:
+                    rhythmizer = None
+            if 'rhythmizer' in declared:
+                rhythmizer = declared['rhythmizer']['filename']
+                if not os.path.isabs(rhythmizer):
+                    rhythmizer = os.path.join(root, rhythmizer)
+            self._bindings[model] = table, rhythmizer
+            return self._bindings[model]
+
+
 def request_to_token(request: dict) -> str:
     req_str = json.dumps(request, ensure_ascii=False, sort_keys=True)
     return hashlib.md5(req_str.encode(encoding='utf-8')).hexdigest()
 
 
+def tensors_to_token(*values) -> str:
+    """
+    Hash a sequence of scalars and arrays. Arrays are hashed by dtype, shape and raw content.
+    """
+    md5 = hashlib.md5()
+    for value in values:
+        if isinstance(value, np.ndarray):
+            md5.update(f'{value.dtype}{value.shape}'.encode(encoding='utf-8'))
+            md5.update(np.ascontiguousarray(value).tobytes())
+        else:
+            md5.update(repr(value).encode(encoding='utf-8'))
+        md5.update(b'\0')
+    return md5.hexdigest()
+
+
+def is_token(value) -> bool:
+    """
+    Tell whether a value sent by a client is a task token, i.e. the hex digest of `tensors_to_token`.
+    Tokens name files in the caches and the shared backend, so nothing else may get that far.
+    """
+    return isinstance(value, str) and re.fullmatch('[0-9a-f]{32}', value) is not None
+
+
 def random_string(length: int) -> str:
     chars = '0123456789abcdef'
     return ''.join(random.choice(chars) for _ in range(length))
@@ -0,0 +1,112 @@
+"""
+Entry points of the worker processes used when server.processes > 0.
+
+Each worker keeps its own warm session pool. The server preprocesses requests itself, so the frame-level inputs
+go to the worker and the waveform comes back through shared memory instead of being pickled; only the request
+fields the models do not read from those arrays (model, speedup) travel with the task. The server owns the input
+block and the worker the output block until `receive` takes it over, and `run` releases both whatever happens.
+"""
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import metrics
+import synthesis
+import utils
+
+_config = {}
+
+
+def initialize(config: dict, preload: list):
+    _config.update(config)
+    sessions_config = config['sessions']
+    utils.session_pool.configure(
+        max_count=sessions_config['max_count'],
+        max_memory=sessions_config['max_memory'] * 1024 * 1024,
+        intra_op_num_threads=sessions_config['intra_op_threads'],
+        inter_op_num_threads=sessions_config['inter_op_threads'],
+        profile_dir=sessions_config['profiling']['directory'] if sessions_config['profiling']['enabled'] else None
+    )
+    for model_path, force_on_cpu in preload:
+        utils.session_pool.get(model_path, config['providers'], force_on_cpu=force_on_cpu)
+
+
+def share(arrays) -> tuple:
+    """
+    Copy arrays into one new shared memory block and return a handle to it for `load` and `release`.
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(sum(a.nbytes for a in arrays), 1))
+    layout = []
+    offset = 0
+    try:
+        for a in arrays:
+            np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf, offset=offset)[...] = a
+            layout.append((a.shape, a.dtype.str, offset))
+            offset += a.nbytes
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    shm.close()
+    return shm.name, layout
+
+
+def load(handle: tuple) -> list:
+    """
+    Copy the arrays of a block made by `share` into this process. The block stays in place.
+    """
+    name, layout = handle
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return [np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset).copy() for shape, dtype, offset in layout]
+    finally:
+        shm.close()
+
+
+def release(handle: tuple):
+    """
+    Unlink a block made by `share`, if it still exists.
+    """
+    try:
+        shm = shared_memory.SharedMemory(name=handle[0])
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+def synthesize(inputs: tuple, request: dict, acoustic: str) -> tuple:
+    with metrics.collect() as timings:
+        waveform = synthesis.run_synthesis(request, None, acoustic, _config, inputs=tuple(load(inputs)))
+    name, layout = share([waveform])
+    return name, layout, timings
+
+
+def run(executor, inputs: tuple, request: dict, acoustic: str) -> np.ndarray:
+    """
+    Synthesize the preprocessed `inputs` of a request in a worker process of `executor`.
+    The phonemes and f0 of the request are not sent, as `inputs` replaces them.
+    """
+    handle = share(inputs)
+    try:
+        result = executor.submit(
+            synthesize, handle, {k: v for k, v in request.items() if k not in ('phonemes', 'f0')}, acoustic
+        ).result()
+    finally:
+        # The task may never have run, e.g. when the pool is shut down with it still queued.
+        release(handle)
+    return receive(result)
+
+
+def receive(result: tuple) -> np.ndarray:
+    """
+    Copy a waveform returned by `synthesize` out of shared memory and release the block.
+    The stage timings measured in the worker are recorded in this process.
+    """
+    name, layout, timings = result
+    try:
+        for stage, elapsed in timings.items():
+            metrics.record(stage, elapsed)
+        return load((name, layout))[0]
+    finally:
+        release((name, layout))